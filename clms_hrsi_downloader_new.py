@@ -47,12 +47,17 @@ import os
 import re
 import sys
 import json
+import zlib
+import struct
+import zipfile
+import sqlite3
 import time
 import logging
 import datetime
 import argparse
-import subprocess
+import threading
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
 
 def validate_Rfc3339(date_text):
@@ -62,6 +67,151 @@ def validate_Rfc3339(date_text):
     except:
         raise ValueError("Incorrect date format, should be YYYY-MM-DDTHH:MM:SSZ")
 
+class HRSITokenManager(object):
+    '''
+    Cache the HR-S&I access token and refresh it shortly before it expires.
+    A single instance is shared by all download workers.
+    '''
+
+    # Token endpoint of the HR-S&I authentication server
+    URL_TOKEN = 'https://cryo.land.copernicus.eu/auth/realms/cryo/protocol/openid-connect/token'
+
+    # Refresh the token this many seconds before it expires
+    REFRESH_MARGIN = 30
+
+    # Connect/read timeout of token requests (seconds), the request holds the lock
+    # every download worker waits on
+    TOKEN_TIMEOUT = 30
+
+    def __init__(self, credentials, session):
+        self.credentials = credentials
+        self.session = session
+        self.access_token = None
+        self.expiry_time = 0.
+        self.lock = threading.Lock()
+
+    def get_token(self):
+        '''Return a valid access token, requesting a new one only when needed.'''
+        with self.lock:
+            if self.access_token is None or \
+                    time.time() >= self.expiry_time - HRSITokenManager.REFRESH_MARGIN:
+                self.__fetch_token__()
+            return self.access_token
+
+    def __fetch_token__(self):
+        data = {
+            'client_id': 'PUBLIC',
+            'username': self.credentials[0],
+            'password': self.credentials[1],
+            'grant_type': 'password'
+        }
+        request_time = time.time()
+        response = self.session.post(HRSITokenManager.URL_TOKEN, data=data,
+                                     timeout=HRSITokenManager.TOKEN_TIMEOUT)
+        try:
+            out = response.json()
+        except ValueError:
+            out = {'error': 'HTTP %s, no JSON response'%(response.status_code)}
+        if 'error' in out or 'access_token' not in out:
+            logging.error("Following error occured when getting the token: {}".format(out))
+            raise RuntimeError("No HR-S&I access token could be obtained: %s"%(
+                out.get('error_description', out.get('error', 'access_token missing'))))
+        self.access_token = out['access_token']
+        # tokens without lifetime are refreshed on every call
+        self.expiry_time = request_time + float(out.get('expires_in', 0))
+        logging.debug("New token valid for %s seconds"%(out.get('expires_in', 0)))
+
+class HRSICatalogue(object):
+    '''
+    Local SQLite store of the HR-S&I products listed by previous queries.
+    Each query, without its observation dates, keeps a watermark, the latest
+    publication date it has seen, and the observation date range it covers,
+    so that later runs only request the products published after the watermark
+    within that range and all products of the range that is not covered yet.
+    '''
+
+    # Observation date limits standing for a query without startDate or completionDate
+    OPEN_MIN = '0000-01-01T00:00:00Z'
+    OPEN_MAX = '9999-12-31T23:59:59Z'
+
+    def __init__(self, catalogue_path):
+        self.catalogue_path = os.path.abspath(catalogue_path)
+        logging.info("The catalogue %s will be used to cache HR-S&I products."%(self.catalogue_path))
+        self.connection = sqlite3.connect(self.catalogue_path)
+        with self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS products (
+                    url TEXT PRIMARY KEY, title TEXT, start_date TEXT,
+                    product_type TEXT, size INTEGER, published TEXT);
+                CREATE TABLE IF NOT EXISTS query_products (
+                    query TEXT, url TEXT, PRIMARY KEY (query, url));
+                CREATE TABLE IF NOT EXISTS syncs (
+                    query TEXT PRIMARY KEY, watermark TEXT, synced TEXT,
+                    obs_min TEXT, obs_max TEXT);
+            ''')
+            # Catalogues written before the observation range was tracked
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(syncs)')]
+            for column in ('obs_min', 'obs_max'):
+                if column not in columns:
+                    self.connection.execute('ALTER TABLE syncs ADD COLUMN %s TEXT'%column)
+
+    def get_sync(self, query):
+        '''
+        Return the (watermark, obs_min, obs_max) synced for a query, None if never synced.
+        :param query: HR-S&I query without observation dates.
+        '''
+        row = self.connection.execute(
+            'SELECT watermark, obs_min, obs_max FROM syncs WHERE query = ?', (query,)).fetchone()
+        if row is None or row[0] is None or row[1] is None:
+            return None
+        return row
+
+    def update(self, query, hrsi_products, obs_range, complete=True):
+        '''
+        Store the products returned by a query, move its watermark forward and
+        record the observation date range it covers.
+        :param query: HR-S&I query without observation dates.
+        :param hrsi_products: list of (url, title, startDate, productType, size, published).
+        :param obs_range: (obs_min, obs_max) of the request, see OPEN_MIN and OPEN_MAX.
+        :param complete: False if some result pages were not fetched. The products are
+            stored but the sync is kept, results are not sorted by publication date
+            so the missing products may be older than the newest product seen.
+        '''
+        sync = self.get_sync(query)
+        watermark = sync[0] if sync else None
+        published = [product[5] for product in hrsi_products if product[5]]
+        if published:
+            # the API expects publication dates without fractional seconds
+            latest = max(published)[:19] + 'Z'
+            watermark = latest if watermark is None else max(watermark, latest)
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?)', hrsi_products)
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO query_products VALUES (?, ?)',
+                [(query, product[0]) for product in hrsi_products])
+            if complete:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO syncs VALUES (?, ?, ?, ?, ?)',
+                    (query, watermark, datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                     obs_range[0], obs_range[1]))
+
+    def get_products(self, query, obs_range=(OPEN_MIN, OPEN_MAX)):
+        '''
+        Return the stored products of a query observed within a date range, most recent first.
+        :param query: HR-S&I query without observation dates.
+        :param obs_range: (obs_min, obs_max) observation date range.
+        '''
+        return self.connection.execute(
+            '''SELECT p.url, p.title, p.start_date, p.product_type, p.size, p.published
+               FROM products p JOIN query_products q ON p.url = q.url
+               WHERE q.query = ? AND p.start_date >= ? AND p.start_date <= ?
+               ORDER BY p.start_date DESC, p.title DESC''',
+            (query, obs_range[0], obs_range[1])).fetchall()
+
+    def close(self):
+        self.connection.close()
+
 class HRSIRequest(object):
     '''
     Request HRSI products in the catalogue.
@@ -116,6 +266,18 @@ class HRSIRequest(object):
         'sortOrder': 'descending'
     }
 
+    # Max number of pooled HTTP connections kept open per host.
+    HTTP_POOL_SIZE = 16
+
+    # Download settings: size of the chunks written to disk (bytes),
+    # connect/read timeout (seconds) and max number of resumed transfers.
+    DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+    HTTP_TIMEOUT = 60
+    MAX_RESUME = 5
+
+    # Number of bytes requested from the end of a zip product to read its central directory.
+    ZIP_TAIL_SIZE = 64 * 1024
+
     def __init__(self, outputPath):
         self.outputPath = os.path.abspath(outputPath)
         if not os.path.exists(self.outputPath):
@@ -126,6 +288,15 @@ class HRSIRequest(object):
         self.hrsi_http_request = None
         self.hrsi_credential = None
         self.result_file = None
+        self.token_manager = None
+
+        # HTTP session reused by all requests, its connections are pooled
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=HRSIRequest.HTTP_POOL_SIZE,
+            pool_maxsize=HRSIRequest.HTTP_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
     def set_hrsi_http_request(self, hrsi_http_request):
         logging.info("The query %s will be used to request HR-S&I products."%(hrsi_http_request))
@@ -205,62 +376,232 @@ class HRSIRequest(object):
         return
 
 
-    def execute_request(self, max_requested_pages=None):
+    def plan_shards(self, http_request, nshards):
+        '''
+        Split the observation date range of a request into date shards.
+        :param http_request: HR-S&I query, with startDate and completionDate parameters.
+        :param nshards: number of date shards.
+        :return: list of shard requests, most recent shard first.
+        '''
+        if nshards is None or nshards <= 1:
+            return [http_request]
+
+        # Read the observation date limits from the request
+        pattern = '([?&]%s=)([^&]+)'
+        date_min = re.search(pattern%HRSIRequest.URL_PARAM_OBSERVATIONDATE_AFTER, http_request)
+        date_max = re.search(pattern%HRSIRequest.URL_PARAM_OBSERVATIONDATE_BEFORE, http_request)
+        try:
+            date_min = datetime.datetime.strptime(date_min.group(2), '%Y-%m-%dT%H:%M:%SZ')
+            date_max = datetime.datetime.strptime(date_max.group(2), '%Y-%m-%dT%H:%M:%SZ')
+        except (AttributeError, ValueError):
+            logging.warning("No valid obsDateMin/obsDateMax found in the request, "
+                            "the catalogue is requested without date shards")
+            return [http_request]
+
+        # Shard limits, rounded to the second. Both limits are inclusive, so each
+        # shard starts one second after the end of the previous one
+        step = (date_max - date_min) / nshards
+        limits = [date_min + i * step for i in range(nshards)] + [date_max]
+        limits = [limit.replace(microsecond=0) for limit in limits]
+        starts = [limits[0]] + [limit + datetime.timedelta(seconds=1) for limit in limits[1:-1]]
+        starts = [start.strftime('%Y-%m-%dT%H:%M:%SZ') for start in starts]
+        limits = [limit.strftime('%Y-%m-%dT%H:%M:%SZ') for limit in limits]
+
+        # Most recent shard first, matching the descending sort order of the pages
+        shard_requests = []
+        for shard_index in reversed(range(nshards)):
+            shard_request = re.sub(pattern%HRSIRequest.URL_PARAM_OBSERVATIONDATE_AFTER,
+                                   lambda m: m.group(1) + starts[shard_index], http_request)
+            shard_request = re.sub(pattern%HRSIRequest.URL_PARAM_OBSERVATIONDATE_BEFORE,
+                                   lambda m: m.group(1) + limits[shard_index + 1], shard_request)
+            shard_requests.append(shard_request)
+        logging.info("Catalogue request split into %d date shards"%len(shard_requests))
+        return shard_requests
+
+    def execute_request(self, max_requested_pages=None, nshards=1, max_workers=1, catalogue=None):
+        '''
+        Request the catalogue and list the resulting products in result_file.txt.
+        :param max_requested_pages: max number of pages requested per date shard.
+        :param nshards: number of date shards the observation date range is split into.
+        :param max_workers: number of pages requested concurrently.
+        :param catalogue: HRSICatalogue, only products published since its last sync, or
+            observed outside the synced observation date range, are requested.
+        '''
         # Check that the request was set before the call
         if self.hrsi_http_request is None:
             logging.error("No hrsi_http_request was provided or configured")
             sys.exit(-2)
 
         logging.info("Requesting : " + self.hrsi_http_request)
+        http_requests = [self.hrsi_http_request]
+
+        # The catalogue syncs the query without its observation dates, so that moving
+        # obsDateMax forward keeps the sync of the range requested before
+        sync_query = self.set_obs_dates(self.hrsi_http_request, None, None)
+        obs_min, obs_max = self.get_obs_dates(self.hrsi_http_request)
+        obs_range = (obs_min or HRSICatalogue.OPEN_MIN, obs_max or HRSICatalogue.OPEN_MAX)
+
+        # Incremental request: within the synced range only ask for products published
+        # after the last sync, outside of it ask for all products
+        if catalogue is not None:
+            sync = catalogue.get_sync(sync_query)
+            if sync is not None:
+                http_requests = self.plan_incremental(self.hrsi_http_request, obs_range, *sync)
+
+        shard_requests = []
+        for http_request in http_requests:
+            shard_requests += self.plan_shards(http_request, nshards)
+        max_workers = max(1, max_workers or 1)
 
         # Send page requests, until no results are returned.
         # The results have a 'totalResults' value that we could use, but
         # it gives wrong and inconsistent values.
+        # Pages are requested in waves: every active shard requests its next
+        # pages, a shard stops as soon as one of its pages is empty.
+
+        # Resulting hrsi_products per (shard index, page index)
+        hrsi_pages = {}
+
+        # Next page to request and active shards
+        next_pages = [1] * len(shard_requests)
+        active_shards = set(range(len(shard_requests)))
+        # Shards that ended on a failed page
+        failed_shards = set()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while active_shards:
+                pages_per_shard = max(1, max_workers // len(active_shards))
+                futures = {}
+                for shard_index in sorted(active_shards):
+                    for _ in range(pages_per_shard):
+                        # First exit condition: max number of pages to request is defined,
+                        # and we have requested enough pages
+                        if (max_requested_pages is not None) and \
+                                (next_pages[shard_index] > max_requested_pages):
+                            break
+                        future = executor.submit(self.request_page, shard_requests[shard_index],
+                                                 next_pages[shard_index], catalogue is not None)
+                        futures[future] = (shard_index, next_pages[shard_index])
+                        next_pages[shard_index] += 1
+                if not futures:
+                    break
 
-        # Resulting hrsi_products
-        hrsi_products = []
-
-        # Number of requested pages
-        requested_pages = 0
-
-        # First exit condition: max number of pages to request is defined,
-        # and we have requested enough pages
-        def first_exit_condition():
-            return (max_requested_pages is not None) and (requested_pages >= max_requested_pages)
-        while not first_exit_condition():
-            requested_pages += 1
-            hrsi_products_aux = self.request_page(self.hrsi_http_request, requested_pages)
+                for future in as_completed(futures):
+                    try:
+                        hrsi_pages[futures[future]] = future.result()
+                    except Exception as e:
+                        logging.error("Result page #%s could not be requested: %s"%(futures[future][1], e))
+                        hrsi_pages[futures[future]] = []
+                        failed_shards.add(futures[future][0])
 
-            # Second exit condition: no results are returned
-            if not hrsi_products_aux:
-                break
+                # Second exit condition: no results are returned
+                for shard_index, page_index in futures.values():
+                    if not hrsi_pages[(shard_index, page_index)]:
+                        active_shards.discard(shard_index)
 
-            # Save results
-            hrsi_products += hrsi_products_aux
+        # Merge the pages in shard and page order
+        hrsi_products = []
+        for key in sorted(hrsi_pages):
+            hrsi_products += hrsi_pages[key]
 
         # Only keep unique values and check for duplicate products
         total_count = len(hrsi_products)
         logging.debug(total_count, hrsi_products)
-        hrsi_products = set(hrsi_products)
+        hrsi_products = list(dict.fromkeys(hrsi_products))
         if len(hrsi_products) != total_count:
             logging.warning('Duplicated HRSI products found.')
 
         logging.info("Found " + str(len(hrsi_products)) + " HR-S&I products.")
 
+        # Merge the new products with the ones already listed in the catalogue.
+        # The watermark only moves if every shard ended on an empty page, shards still
+        # active stopped at max_requested_pages
+        if catalogue is not None:
+            complete = not active_shards and not failed_shards
+            if not complete:
+                logging.warning("Not all result pages were requested, the catalogue watermark is kept")
+            catalogue.update(sync_query, hrsi_products, obs_range, complete)
+            hrsi_products = catalogue.get_products(sync_query, obs_range)
+            logging.info("Listing " + str(len(hrsi_products)) + " HR-S&I products from the catalogue.")
+
         # Save result file in the output folder
         self.set_result_file(os.path.join(self.outputPath, "result_file.txt"))
         logging.info("Listing results in " + self.result_file)
         with open(self.result_file, 'w') as f:
-            f.writelines([";".join(res)+"\n" for res in hrsi_products])
+            f.writelines([";".join(res[:2])+"\n" for res in hrsi_products])
         return
 
-    def request_page(self, http_request, page_index):
-        '''Request one page of HRSI products (each page contains URL_PAGE_SIZE products).'''
+    def plan_incremental(self, http_request, obs_range, watermark, synced_min, synced_max):
+        '''
+        Split a request into the requests of an incremental catalogue sync.
+        :param http_request: HR-S&I query.
+        :param obs_range: (obs_min, obs_max) observation date range of the query.
+        :param watermark: latest publication date synced.
+        :param synced_min, synced_max: observation date range covered by the sync.
+        :return: list of requests with non-overlapping observation date ranges.
+        '''
+        def shift(date, seconds):
+            return (datetime.datetime.strptime(date, '%Y-%m-%dT%H:%M:%SZ') +
+                    datetime.timedelta(seconds=seconds)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        overlap_min, overlap_max = max(obs_range[0], synced_min), min(obs_range[1], synced_max)
+        if overlap_min > overlap_max:
+            logging.info("Catalogue synced for other observation dates, requesting all products")
+            return [http_request]
+
+        logging.info("Catalogue synced until %s for %s to %s, requesting newer products only"%(
+            watermark, synced_min, synced_max))
+        http_requests = [self.set_published_after(
+            self.set_obs_dates(http_request, overlap_min, overlap_max), watermark)]
+        # Observation dates outside the synced range are requested in full
+        if obs_range[1] > synced_max:
+            http_requests.insert(0, self.set_obs_dates(http_request, shift(synced_max, 1), obs_range[1]))
+        if obs_range[0] < synced_min:
+            http_requests.append(self.set_obs_dates(http_request, obs_range[0], shift(synced_min, -1)))
+        return http_requests
+
+    def get_obs_dates(self, http_request):
+        '''Return the startDate and completionDate of a request, None if not set.'''
+        dates = []
+        for param in (HRSIRequest.URL_PARAM_OBSERVATIONDATE_AFTER, HRSIRequest.URL_PARAM_OBSERVATIONDATE_BEFORE):
+            match = re.search('[?&]%s=([^&]+)'%param, http_request)
+            dates.append(match.group(1) if match else None)
+        return tuple(dates)
+
+    def set_obs_dates(self, http_request, obs_min, obs_max):
+        '''
+        Set the startDate and completionDate of a request. Dates that are None or open
+        (see HRSICatalogue.OPEN_MIN and OPEN_MAX) are removed from the request.
+        '''
+        for param, date, open_date in ((HRSIRequest.URL_PARAM_OBSERVATIONDATE_AFTER, obs_min, HRSICatalogue.OPEN_MIN),
+                                       (HRSIRequest.URL_PARAM_OBSERVATIONDATE_BEFORE, obs_max, HRSICatalogue.OPEN_MAX)):
+            http_request = re.sub('&%s=[^&]+'%param, '', http_request)
+            http_request = re.sub('\\?%s=[^&]+&?'%param, '?', http_request)
+            if date is not None and date != open_date:
+                http_request = '%s&%s=%s'%(http_request, param, date)
+        return http_request
+
+    def set_published_after(self, http_request, published_after):
+        '''Set the publishedAfter parameter of a request, keeping the latest of both dates.'''
+        pattern = '([?&]%s=)([^&]+)'%HRSIRequest.URL_PARAM_PUBLISHED_AFTER
+        match = re.search(pattern, http_request)
+        if match is None:
+            return '%s&%s=%s'%(http_request, HRSIRequest.URL_PARAM_PUBLISHED_AFTER, published_after)
+        return re.sub(pattern, lambda m: m.group(1) + max(m.group(2), published_after), http_request)
+
+    def request_page(self, http_request, page_index, raise_errors=False):
+        '''
+        Request one page of HRSI products (each page contains URL_PAGE_SIZE products).
+        :param raise_errors: raise on HTTP errors and malformed responses instead of
+            returning an empty page, which would end the shard.
+        '''
         current_page = http_request + '&page=' + str(page_index)
         logging.info("Processing result page #%s"%(str(page_index)))
 
         # Send Get request
-        response = requests.get(current_page)
+        response = self.session.get(current_page, timeout=HRSIRequest.HTTP_TIMEOUT)
+        if raise_errors:
+            response.raise_for_status()
 
         # Read JSON response
         json_root = {}
@@ -271,11 +612,13 @@ class HRSIRequest(object):
         try:
             features = json_root["features"]
         except KeyError:
+            if raise_errors:
+                raise ValueError('features entry is missing from the JSON response of %s'%(current_page))
             features = {}
             logging.error('features entry is missing from the JSON response:\n%s'\
                 '\nurl parameters requested : \n%s' %(
                 json.dumps(json_root, indent=4),
-                json.dumps(url_params_page, indent=4)
+                current_page
             ))
 
         # Resulting hrsi products
@@ -305,7 +648,7 @@ class HRSIRequest(object):
         hrsi_url = read('services')['download']['url']
         hrsi_size = read('services')['download']['size']
         hrsi_publication_date = read('published')
-        return (hrsi_url, hrsi_title)
+        return (hrsi_url, hrsi_title, hrsi_obs_date, hrsi_product_type, hrsi_size, hrsi_publication_date)
 
     def read_json_param(self, json_root, feature, feature_index, json_param):
         '''Read a JSON parameter.'''
@@ -316,21 +659,18 @@ class HRSIRequest(object):
                 'features[%d][\'properties\'][\'%s\'] entry is missing from the JSON contents:\n%s' %
                 (feature_index, json_param, json.dumps(json_root, indent=4)))
 
-    def __get_token__(self, credentials):
-        command = ['curl -s -d "client_id=PUBLIC"']
-        command.append('-d "username=%s"'%credentials[0])
-        command.append('-d "password=%s"'%credentials[1])
-        command.append('-d "grant_type=password"')
-        command.append('"https://cryo.land.copernicus.eu/auth/realms/cryo/protocol/openid-connect/token"')
-        out = eval(subprocess.check_output(" ".join(command), shell=True))
-        if 'error' in out:
-           logging.error("Following error occured when getting the token: {}".format(out))
-        return out['access_token']
-
-    def __hrsi_adress__(self, adress_id, credentials):
-        return '%s?token=%s'%(adress_id, self.__get_token__(credentials))
-
-    def download(self):
+    def __get_token__(self):
+        return self.token_manager.get_token()
+
+    def __hrsi_adress__(self, adress_id):
+        return '%s?token=%s'%(adress_id, self.__get_token__())
+
+    def download(self, max_workers=1, members=None):
+        '''
+        Download all products listed in the result file.
+        :param max_workers: number of products downloaded concurrently, 1 downloads sequentially.
+        :param members: list of archive members to fetch (e.g. ['WSM']), None downloads the whole archive.
+        '''
         # Check that the hrsi_credential was set before the call
         if self.hrsi_credential is None:
             logging.error("No HR-S&I credential file was provided")
@@ -346,6 +686,7 @@ class HRSIRequest(object):
             logging.error("Error while parsing credential file: " + str(self.hrsi_credential))
             raise
             sys.exit(-2)
+        self.token_manager = HRSITokenManager(credentials, self.session)
 
 
         # Check that the result file was set before the call
@@ -365,47 +706,191 @@ class HRSIRequest(object):
             raise
             sys.exit(-2)
         # loop to download all products within the list
-        for info_product in product_list:
-            start_time = time.time()
-            ntries = 0
-            max_retry = 1
-            while(ntries < max_retry):
-                try:
-                    # first info must be product url (mandatory)
-                    product_url = info_product[0]
-                    adress = self.__hrsi_adress__(product_url, credentials)
-
-                    # second info is product name (optional)
-                    dl_filename = None
-                    if len(info_product) >= 2:
-                        dl_filename = '%s.zip'%(info_product[1].split('/')[-1])
-
-                    # start actual download
-                    hrsi_filepath = self.download_with_curl(adress, dl_filename)
-                    logging.info('Product successfully downloaded at %s (in %s seconds)'\
-                                    %(hrsi_filepath, (time.time()-start_time)))
-                    break
-                except:
-                    ntries += 1
-                    if ntries == max_retry:
-                        raise
-                    else:
-                        time.sleep(5.*ntries)
-                        logging.info('  - try #%d failed, retrying...'%ntries)
-
-    def download_with_curl(self, product_url, dl_filename=None):
-        # parse header to read remote filename
-        if dl_filename is None:
-            import re
-            headers = str(subprocess.check_output('curl -sI %s'%(product_url), shell=True))
-            dl_filename = re.findall("filename=(\S+)",str(headers))[0].split('\\r')[0]
-            assert dl_filename.endswith('.zip')
+        if max_workers is None or max_workers <= 1:
+            for info_product in product_list:
+                self.download_product(info_product, members)
+        else:
+            logging.info("Downloading %d products with %d workers"%(len(product_list), max_workers))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(self.download_product, info_product, members): info_product
+                           for info_product in product_list}
+                for future in as_completed(futures):
+                    # re-raise the error of a product whose retries are exhausted
+                    future.result()
+
+    def download_product(self, info_product, members=None):
+        '''Download one product of the result file, retrying on failure.'''
+        start_time = time.time()
+        ntries = 0
+        max_retry = 1
+        while(ntries < max_retry):
+            try:
+                # first info must be product url (mandatory)
+                product_url = info_product[0]
+
+                # second info is product name (optional)
+                dl_filename = None
+                if len(info_product) >= 2:
+                    dl_filename = '%s.zip'%(info_product[1].split('/')[-1])
+
+                # start actual download
+                if members and dl_filename is not None:
+                    hrsi_filepath = self.download_members(product_url, dl_filename, members)
+                else:
+                    hrsi_filepath = self.download_stream(product_url, dl_filename)
+                logging.info('Product successfully downloaded at %s (in %s seconds)'\
+                                %(hrsi_filepath, (time.time()-start_time)))
+                return hrsi_filepath
+            except:
+                ntries += 1
+                if ntries == max_retry:
+                    raise
+                else:
+                    time.sleep(5.*ntries)
+                    logging.info('  - try #%d failed, retrying...'%ntries)
+
+    def download_stream(self, product_url, dl_filename=None):
+        '''
+        Stream a product to outputPath over the pooled HTTP session.
+        Data is written to a .part file which is resumed with HTTP Range requests
+        after an interruption, and renamed to its final name once complete.
+        :param product_url: product download url, without token.
+        :param dl_filename: local filename, read from the response header if None.
+        :return: path of the downloaded product.
+        '''
+        nresumes = 0
+        while True:
+            # a fresh token is requested for every attempt, long transfers may outlive it
+            adress = self.__hrsi_adress__(product_url)
+            part_filepath = None
+            offset = 0
+            headers = {}
+            if dl_filename is not None:
+                part_filepath = os.path.join(self.outputPath, dl_filename + '.part')
+                if os.path.exists(part_filepath):
+                    offset = os.path.getsize(part_filepath)
+                    headers['Range'] = 'bytes=%d-'%offset
+            try:
+                with self.session.get(adress, headers=headers, stream=True,
+                                      timeout=HRSIRequest.HTTP_TIMEOUT) as response:
+                    # the .part file already holds the whole product
+                    if response.status_code == 416:
+                        break
+                    response.raise_for_status()
+
+                    # parse header to read remote filename
+                    if dl_filename is None:
+                        dl_filename = re.findall('filename="?([^";]+)',
+                                                 response.headers.get('Content-Disposition', ''))[0]
+                        assert dl_filename.endswith('.zip')
+                        part_filepath = os.path.join(self.outputPath, dl_filename + '.part')
+                    logging.info(dl_filename + " " + product_url)
+
+                    # the server ignored the Range header, start again from byte zero
+                    if response.status_code != 206:
+                        offset = 0
+                    elif offset:
+                        logging.info('  - resuming %s at byte %d'%(dl_filename, offset))
+
+                    with open(part_filepath, 'ab' if offset else 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=HRSIRequest.DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+                break
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout):
+                nresumes += 1
+                if nresumes > HRSIRequest.MAX_RESUME or dl_filename is None:
+                    raise
+                time.sleep(5.*nresumes)
+                logging.info('  - transfer of %s interrupted, resume #%d...'%(dl_filename, nresumes))
+
         # download the product in outputPath
-        logging.info(dl_filename + " " + product_url.split("?token")[0])
         hrsi_filepath = os.path.join(self.outputPath, dl_filename)
+        os.replace(part_filepath, hrsi_filepath)
         logging.debug('DL filepath: ' + hrsi_filepath)
-        subprocess.check_call('curl %s -o %s -s'%(product_url, hrsi_filepath), shell=True)
-        logging.debug('DL command: ' + 'curl %s -o %s -s'%(product_url, hrsi_filepath))
+        return hrsi_filepath
+
+    def __fetch_range__(self, product_url, start, end=None):
+        '''
+        Request a byte range of a product, end is inclusive.
+        A negative start without end requests the last -start bytes.
+        :return: response content and total size of the product.
+        '''
+        byte_range = 'bytes=%d'%start if end is None else 'bytes=%d-%d'%(start, end)
+        response = self.session.get(self.__hrsi_adress__(product_url), headers={'Range': byte_range},
+                                    timeout=HRSIRequest.HTTP_TIMEOUT)
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError("Range requests are not supported for %s"%product_url)
+        total_size = int(response.headers['Content-Range'].split('/')[-1])
+        return response.content, total_size
+
+    def download_members(self, product_url, dl_filename, members):
+        '''
+        Fetch only some members of a remote zip product with HTTP Range requests.
+        The central directory is read from the end of the archive, then only the
+        byte ranges of the requested members are downloaded and stored in a local
+        zip with the same name, member paths and compression methods as the original product.
+        :param product_url: product download url, without token.
+        :param dl_filename: local filename of the product.
+        :param members: suffixes of the members to fetch, e.g. ['WSM'] for <scene>/<scene>_WSM.tif.
+        :return: path of the downloaded product.
+        '''
+        logging.info(dl_filename + " " + product_url + " (members: %s)"%(",".join(members)))
+
+        # read the end of central directory record from the tail of the archive
+        tail, total_size = self.__fetch_range__(product_url, -HRSIRequest.ZIP_TAIL_SIZE)
+        tail_offset = total_size - len(tail)
+        eocd_index = tail.rfind(b'PK\x05\x06')
+        if eocd_index < 0:
+            raise IOError("No zip central directory found in %s"%dl_filename)
+        cd_size, cd_offset = struct.unpack('<II', tail[eocd_index + 12:eocd_index + 20])
+        if cd_offset == 0xFFFFFFFF:
+            raise IOError("ZIP64 archives are not supported: %s"%dl_filename)
+
+        # read the central directory, requesting it only if it is not in the tail
+        if cd_offset >= tail_offset:
+            central_directory = tail[cd_offset - tail_offset:cd_offset - tail_offset + cd_size]
+        else:
+            central_directory, _ = self.__fetch_range__(product_url, cd_offset, cd_offset + cd_size - 1)
+
+        # list the requested members
+        entries = []
+        index = 0
+        while index + 46 <= len(central_directory):
+            (signature, _, _, _, method, _, _, crc, comp_size, _, name_len, extra_len, comment_len,
+             _, _, _, local_offset) = struct.unpack('<4sHHHHHHIIIHHHHHII', central_directory[index:index + 46])
+            if signature != b'PK\x01\x02':
+                break
+            name = central_directory[index + 46:index + 46 + name_len].decode('utf-8')
+            index += 46 + name_len + extra_len + comment_len
+            if any(os.path.splitext(name)[0].endswith('_' + member) for member in members):
+                entries.append((name, method, crc, comp_size, local_offset))
+        if not entries:
+            raise IOError("No member matching %s found in %s"%(members, dl_filename))
+
+        # fetch and store the members in a local zip
+        hrsi_filepath = os.path.join(self.outputPath, dl_filename)
+        part_filepath = hrsi_filepath + '.part'
+        with zipfile.ZipFile(part_filepath, 'w', zipfile.ZIP_STORED) as local_zip:
+            for name, method, crc, comp_size, local_offset in entries:
+                # the local header may hold a different extra field than the central directory
+                end = min(local_offset + 30 + len(name.encode('utf-8')) + comp_size + 0xFFFF, total_size) - 1
+                content, _ = self.__fetch_range__(product_url, local_offset, end)
+                name_len, extra_len = struct.unpack('<HH', content[26:30])
+                data = content[30 + name_len + extra_len:30 + name_len + extra_len + comp_size]
+                if method == zipfile.ZIP_DEFLATED:
+                    data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+                elif method != zipfile.ZIP_STORED:
+                    raise IOError("Unsupported compression method %d for %s"%(method, name))
+                if zlib.crc32(data) & 0xFFFFFFFF != crc:
+                    raise IOError("CRC check failed for %s in %s"%(name, dl_filename))
+                # keep the compression method of the original member, so that the
+                # partial product takes no more disk space than in the archive
+                local_zip.writestr(name, data, compress_type=method)
+                logging.debug('  - fetched %s (%d bytes)'%(name, comp_size))
+        os.replace(part_filepath, hrsi_filepath)
         return hrsi_filepath
 
 def main():
@@ -436,9 +921,11 @@ def main():
     group_query.add_argument("-publicationDateMin", type=str, help="2020-06-02T00:00:00Z")
     group_query.add_argument("-publicationDateMax", type=str, help="2020-06-02T00:00:00Z")
     group_query.add_argument("-cloudCoverageMax", type=int, help="0-100 (percent)")
+    group_query.add_argument("-query_shards", type=int, default=1, help="number of date shards the obsDateMin/obsDateMax range is split into (default: 1)")
     group_query.add_argument("-textualSearch", type=str, help="\"Winter in Finland\"")
     group_query.add_argument("-geometry", type=str, help="WKT geometry as text")
     group_query.add_argument("-mission", type=str, help="S1|S2|S1-S2")
+    group_query.add_argument("-catalogue", type=str, help="SQLite file caching the query results, later queries only request newly published products")
 
 
     # Parameters to download products from urls obtained through the HR-S&I finder
@@ -447,6 +934,10 @@ def main():
         help='text file containing valid login and password for HR-S&I portal (required for all downloading operations) in the following format: \"login:password\"')
     group_download.add_argument("-result_file", type=str, \
         help="to use the result file from previous query or containing multiple copied urls (required only for download mode)")
+    group_download.add_argument("-max_workers", type=int, default=1, \
+        help="number of products downloaded or catalogue pages requested concurrently (default: 1, sequential)")
+    group_download.add_argument("-members", type=str, nargs='?', const='WSM', \
+        help="only fetch the archive members with these comma separated suffixes (default if flag given: WSM), the whole archive is downloaded otherwise")
 
     args = parser.parse_args()
 
@@ -474,7 +965,11 @@ def main():
                                 args.textualSearch)
 
         # Query HTTP API to list results
-        hrsi.execute_request()
+        catalogue = HRSICatalogue(args.catalogue) if args.catalogue else None
+        hrsi.execute_request(nshards=args.query_shards, max_workers=args.max_workers,
+                             catalogue=catalogue)
+        if catalogue is not None:
+            catalogue.close()
 
     # Switch to download from file mode (if enable)
     if args.download:
@@ -487,7 +982,8 @@ def main():
     if args.query_and_download or args.download:
         hrsi.set_hrsi_credential(args.hrsi_credentials)
         logging.info("Start downloading...")
-        hrsi.download();
+        members = args.members.split(',') if args.members else None
+        hrsi.download(args.max_workers, members)
         logging.info("Downloading complete!")
     else:
         logging.info("No products were downloaded.")
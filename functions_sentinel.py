@@ -9,55 +9,474 @@ The general aim is to derive wet snow areas.
 
 @author: luis
 '''
-import os, glob, sys, zipfile, math
-from osgeo import gdal, gdalconst, osr, ogr
+import os, glob, sys, zipfile, math, json, hashlib, sqlite3, queue, atexit
+import logging, logging.handlers, multiprocessing.util, time, tracemalloc, tempfile
+from contextlib import contextmanager, nullcontext
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+from osgeo import gdal, gdal_array, gdalconst, osr, ogr
 from datetime import datetime as dt
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
 
+#### SWS class schemes #########################################################
+
+# SWS class codes by class name, as used for the per-scene class statistics
+SWS_CLASSES = {
+    "wet": 110,             # Wet snow
+    "dry": 125,             # Dry snow or snow free or patchy snow
+    "shadow_layover": 200,  # Radar shadow / layover / foreshortening
+    "water": 210,           # Water
+    "forest": 220,          # Forest
+    "urban": 230,           # Urban area
+    "non_mountain": 240,    # Non-mountain areas
+    "nodata": 255,          # No data
+}
+
+# Reclassification schemes for SWS class codes, as {SWS code: new code}.
+# Codes that are not listed keep their value (e.g. 255 - noData).
+# "all_classes": wet snow 1, dry snow 0, other classes 21..25
+# "binary": wet snow 1, dry snow 0, other classes set to noData (255)
+CLASS_SCHEMES = {
+    "all_classes": {
+        110: 1,   # Wet snow
+        125: 0,   # Dry snow or snow free or patchy snow
+        200: 21,  # Radar shadow / layover / foreshortening
+        210: 22,  # Water
+        220: 23,  # Forest
+        230: 24,  # Urban area
+        240: 25,  # Non-mountain areas
+    },
+    "binary": {
+        110: 1,   # Wet snow
+        125: 0,   # Dry snow or snow free or patchy snow
+        200: 255, # Radar shadow / layover / foreshortening
+        210: 255, # Water
+        220: 255, # Forest
+        230: 255, # Urban area
+        240: 255, # Non-mountain areas
+    },
+}
+
+# Colours of the SWS classes as RGB, as in the maps of process_and_plot_tif_all_classes
+SWS_COLORS = {
+    "wet": (0, 0, 255),             # blue
+    "dry": (128, 128, 128),         # grey
+    "shadow_layover": (0, 0, 0),    # black
+    "water": (0, 255, 255),         # cyan
+    "forest": (0, 128, 0),          # green
+    "urban": (255, 0, 0),           # red
+    "non_mountain": (255, 255, 0),  # yellow
+}
+
+def build_color_table(scheme=None):
+    #%%
+    """
+    Builds a GDAL colour table of the SWS classes, noData (255) is transparent.
+
+    Parameters:
+    scheme (str or dict, optional): The reclassification scheme of the grid, see
+                                    CLASS_SCHEMES. Default is None for the SWS codes.
+
+    Returns:
+    gdal.ColorTable: The colour table, for Byte grids.
+    """
+    if isinstance(scheme, str):
+        scheme = CLASS_SCHEMES[scheme]
+    color_table = gdal.ColorTable()
+    for name, rgb in SWS_COLORS.items():
+        code = SWS_CLASSES[name] if scheme is None else scheme.get(SWS_CLASSES[name], SWS_CLASSES[name])
+        if code != 255:
+            color_table.SetColorEntry(code, rgb + (255,))
+    color_table.SetColorEntry(255, (0, 0, 0, 0))
+    return color_table
+#%%
+
+
+#### Logging ###################################################################
+
+# Logger of the SWS processing, configured once per run with setup_logging
+logger = logging.getLogger("sentinel")
+
+# Handlers and listener thread of the configured logger
+_LOG_HANDLERS = []
+_LOG_LISTENER = None
+
+
+class JsonLinesHandler(logging.Handler):
+    #%%
+    """
+    Log handler that buffers records as JSON lines and appends them to the log
+    file in batches, so that logging does not cost a file open per message.
+    The buffer is also written whenever the log queue runs idle, see FlushingQueueListener.
+
+    Parameters:
+    log_path (str): The path to the log file.
+    capacity (int): Number of buffered lines that triggers a write. Default is 200.
+    """
+    def __init__(self, log_path, capacity=200):
+        super().__init__()
+        self.log_path = log_path
+        self.capacity = capacity
+        self.buffer = []
+
+    def emit(self, record):
+        # Serialise the record as one JSON object per line
+        self.buffer.append(json.dumps({
+            "time": dt.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "process": record.process,
+            "message": record.getMessage(),
+        }))
+        if len(self.buffer) >= self.capacity:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        # Append the batch with a single write, so that the lines of parallel
+        # worker processes do not interleave within a batch
+        lines = ("\n".join(self.buffer) + "\n").encode("utf-8")
+        self.buffer = []
+        fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines)
+        finally:
+            os.close(fd)
+#%%
+
+class FlushingQueueListener(logging.handlers.QueueListener):
+    #%%
+    """
+    Queue listener that writes the buffered records of its handlers once the queue
+    has been idle for flush_delay seconds, and at least every flush_interval seconds
+    while records keep arriving, so that a killed process loses at most a few seconds of log.
+
+    Parameters:
+    log_queue (Queue): The queue of the log records.
+    *handlers: The handlers of the records.
+    flush_delay (float): Idle time of the queue in seconds that triggers a flush. Default is 0.5.
+    flush_interval (float): Maximum time in seconds between flushes. Default is 5.
+    """
+    def __init__(self, log_queue, *handlers, flush_delay=0.5, flush_interval=5.0):
+        super().__init__(log_queue, *handlers)
+        self.flush_delay = flush_delay
+        self.flush_interval = flush_interval
+        self.flushed = time.monotonic()
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+        self.flushed = time.monotonic()
+
+    def dequeue(self, block):
+        try:
+            record = self.queue.get(timeout=self.flush_delay)
+        except queue.Empty:
+            # The queue is idle, write the buffered records and wait for the next one
+            self.flush()
+            record = self.queue.get(block=block)
+        if time.monotonic() - self.flushed > self.flush_interval:
+            self.flush()
+        return record
+#%%
+
+def _start_log_listener():
+    #%%
+    """
+    Starts the background thread that drains the log queue into the configured
+    handlers and attaches a queue handler to the logger.
+    """
+    global _LOG_LISTENER
+    log_queue = queue.SimpleQueue()
+    logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    _LOG_LISTENER = FlushingQueueListener(log_queue, *_LOG_HANDLERS)
+    _LOG_LISTENER.start()
+#%%
+
+def stop_logging():
+    #%%
+    """
+    Stops the log listener thread and writes all buffered log records to disk.
+    Registered to run at interpreter exit.
+    """
+    global _LOG_LISTENER
+    if _LOG_LISTENER is not None:
+        _LOG_LISTENER.stop()  # Drains the queue before returning
+        _LOG_LISTENER = None
+    for handler in _LOG_HANDLERS:
+        handler.flush()
+#%%
+
+def _restart_logging_in_child():
+    #%%
+    """
+    Restarts logging in a forked worker process. The listener thread of the
+    parent does not survive the fork, and records buffered in the parent must
+    not be written a second time by the child.
+    """
+    if _LOG_LISTENER is None:
+        return
+    for handler in _LOG_HANDLERS:
+        if isinstance(handler, JsonLinesHandler):
+            handler.buffer = []
+    _start_log_listener()
+#%%
+
+def setup_logging(log_path, level="INFO", console=True):
+    #%%
+    """
+    Configures the SWS logger: records are queued by the caller, formatted as
+    JSON lines on a background thread and written to the log file in batches.
+
+    Parameters:
+    log_path (str): The path to the JSON-lines log file.
+    level (str or int): Verbosity of the logger. The per-scene messages of the hot
+                        path (debug_log) are only emitted at "DEBUG". Default is "INFO".
+    console (bool): If True, records are also printed to the console. Default is True.
+    """
+    global _LOG_HANDLERS
+    stop_logging()
+
+    _LOG_HANDLERS = [JsonLinesHandler(log_path)]
+    if console:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter("%(message)s"))
+        # Records logged with extra={"console": False} only go to the file
+        console_handler.addFilter(lambda record: getattr(record, "console", True))
+        _LOG_HANDLERS.append(console_handler)
+
+    logger.setLevel(level)
+    logger.propagate = False
+    _start_log_listener()
+#%%
+
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=_restart_logging_in_child)
+# multiprocessing workers leave through os._exit, which skips the atexit handlers
+multiprocessing.util.register_after_fork(
+    logger, lambda _: multiprocessing.util.Finalize(None, stop_logging, exitpriority=10))
+
+
+#### Profiling #################################################################
+
+# State of the stage profiler, see enable_profiling. Records are dictionaries of
+# stage, scene, wall and CPU seconds, bytes read and written and peak memory
+_PROFILE = {"enabled": False, "records": [], "stack": [], "start": None}
+
+
+def _io_counters():
+    #%%
+    """
+    Returns the bytes read and written by the current process so far, including
+    reads served from the page cache. Returns (None, None) where /proc is not available.
+    """
+    try:
+        with open("/proc/self/io") as io_file:
+            counters = dict(line.split(": ") for line in io_file.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+#%%
+
+def enable_profiling():
+    #%%
+    """
+    Turns on the stage profiler. Until then profile_stage does nothing, so the
+    instrumentation costs nothing in normal runs.
+    Peak memory is measured with tracemalloc, which covers the NumPy arrays but
+    not the memory allocated inside GDAL.
+    """
+    _PROFILE["enabled"] = True
+    _PROFILE["start"] = (time.perf_counter(), time.process_time())
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+#%%
+
+@contextmanager
+def _profiled_stage(stage, scene):
+    #%%
+    """
+    Measures one stage, see profile_stage.
+    """
+    stack = _PROFILE["stack"]
+    # Nested stages are named after their enclosing stage and inherit its scene
+    if stack:
+        name = "{}/{}".format(stack[-1]["stage"], stage)
+        scene = stack[-1]["scene"] if scene is None else scene
+        # Keep the peak of the enclosing stage, before resetting it for this stage
+        stack[-1]["peak"] = max(stack[-1]["peak"], tracemalloc.get_traced_memory()[1])
+    else:
+        name = stage
+    tracemalloc.reset_peak()
+    entry = {"stage": name, "scene": scene, "peak": 0}
+    stack.append(entry)
+
+    read_start, written_start = _io_counters()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        read_end, written_end = _io_counters()
+        stack.pop()
+        peak = max(entry["peak"], tracemalloc.get_traced_memory()[1])
+        if stack:
+            stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+        _PROFILE["records"].append({
+            "stage": name,
+            "scene": scene,
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "bytes_read": None if read_start is None else read_end - read_start,
+            "bytes_written": None if written_start is None else written_end - written_start,
+            "peak_memory": peak,
+        })
+#%%
+
+def profile_stage(stage, scene=None):
+    #%%
+    """
+    Context manager recording the wall and CPU time, bytes read and written and peak
+    memory of a processing stage, if profiling is enabled (see enable_profiling).
+
+    Parameters:
+    stage (str): The name of the stage, e.g. "read". Stages nested in another
+                 stage are recorded as "<outer>/<stage>".
+    scene (str, optional): The scene the stage works on. Nested stages default to
+                           the scene of the enclosing stage.
+
+    Returns:
+    A context manager, e.g. used as: with profile_stage("read", scene_name): ...
+    """
+    if not _PROFILE["enabled"]:
+        return nullcontext()
+    return _profiled_stage(stage, scene)
+#%%
+
+def take_profile_records():
+    #%%
+    """
+    Removes and returns the stage records of this process, e.g. to send the records
+    of a worker process back to the main process (see add_profile_records).
+
+    Returns:
+    list: The records, as dictionaries.
+    """
+    records = _PROFILE["records"]
+    _PROFILE["records"] = []
+    return records
+#%%
+
+def add_profile_records(records):
+    #%%
+    """
+    Adds stage records of a worker process to the records of this process.
+
+    Parameters:
+    records (list): The records returned by take_profile_records in the worker.
+    """
+    _PROFILE["records"].extend(records)
+#%%
+
+def profile_report(report_path):
+    #%%
+    """
+    Summarizes the stage records per stage, logs the summary table and writes the
+    machine-readable report with the totals, the summary and every per-scene record.
+
+    Parameters:
+    report_path (str): The path to the JSON report file.
+
+    Returns:
+    DataFrame: The summary table, indexed by stage.
+    """
+    records = pd.DataFrame(_PROFILE["records"], columns=["stage", "scene", "wall_s", "cpu_s", "bytes_read",
+                                                         "bytes_written", "peak_memory"])
+    summary = records.groupby("stage").agg(
+        count=("wall_s", "size"),
+        wall_s=("wall_s", "sum"),
+        wall_mean_s=("wall_s", "mean"),
+        cpu_s=("cpu_s", "sum"),
+        bytes_read=("bytes_read", "sum"),
+        bytes_written=("bytes_written", "sum"),
+        peak_memory=("peak_memory", "max"),
+    ).sort_values("wall_s", ascending=False)
+
+    # Totals of the run, the CPU time and peak memory of the worker processes are
+    # only included once they have exited
+    wall_start, cpu_start = _PROFILE["start"] or (time.perf_counter(), time.process_time())
+    # Nested stages are part of their enclosing stage, only the outer stages are summed
+    outer = records[~records["stage"].str.contains("/")]
+    total = {
+        "wall_s": time.perf_counter() - wall_start,
+        "cpu_s": time.process_time() - cpu_start,
+        "stage_wall_s": float(outer["wall_s"].sum()),
+        "stage_cpu_s": float(outer["cpu_s"].sum()),
+        "bytes_read": int(outer["bytes_read"].sum()),
+        "bytes_written": int(outer["bytes_written"].sum()),
+        "peak_traced_memory": int(records["peak_memory"].max()) if len(records) else 0,
+    }
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux
+        total["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        total["cpu_children_s"] = children.ru_utime + children.ru_stime
+        total["peak_rss_children"] = children.ru_maxrss * 1024
+
+    logger.info("Stage profile:\n{}".format(summary.to_string(float_format=lambda value: f"{value:.3f}")))
+    logger.info("Total: {}".format(", ".join(f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}"
+                                             for key, value in total.items())))
+
+    # to_json writes missing values as null and converts the NumPy types
+    report = {
+        "total": total,
+        "stages": json.loads(summary.reset_index().to_json(orient="records")),
+        "records": json.loads(records.to_json(orient="records")),
+    }
+    with open(report_path, "w") as report_file:
+        json.dump(report, report_file, indent=1)
+    return summary
+#%%
+
+# Records collected before a fork belong to the parent process
+os.register_at_fork(after_in_child=lambda: _PROFILE.update(records=[], stack=[]))
+
+
 #### from former run_SWS_processing_temp.py ########################################
 
 def debug_log(message, log_path):
     #%%
     """
-    Logs a debug message to the console and a log file with a timestamp.
+    Logs a debug message of the per-scene hot path. The message is only emitted
+    if the logger runs at "DEBUG" verbosity (see setup_logging).
     
     Parameters:
     message (str): The message to log.
-    
-    Prints:
-    The message to the console.
-    
-    Writes:
-    The message to a log file with a timestamp.
+    log_path (str): The log file, used if logging has not been set up yet.
     """
-    print(message)  # Print the message to the console
-    with open(log_path, "a") as log_file:  # Open the log file in append mode
-        log_file.write(f"{dt.now()}: {message}\n")  # Write the message with a timestamp
+    if not logger.handlers:
+        setup_logging(log_path)
+    logger.debug(message)
 #%%
 
 
-def read_ascii_grid(filename):
+def read_ascii_header(filename):
     #%%
     """
-    Reads an ASCII grid file and extracts the header information and data.
+    Reads only the header of an ASCII grid file.
 
     Parameters:
     filename (str): The path to the ASCII grid file.
 
     Returns:
-    tuple: A tuple containing the following elements:
-        - ncols (int): Number of columns in the grid.
-        - nrows (int): Number of rows in the grid.
-        - xllcorner (float): X coordinate of the lower left corner.
-        - yllcorner (float): Y coordinate of the lower left corner.
-        - cellsize (float): Size of each cell.
-        - nodata_value (float): Value used to represent no data.
-        - data (ndarray): 2D array of grid data.
+    tuple: A tuple containing ncols, nrows, xllcorner, yllcorner, cellsize and nodata_value
+           (see read_ascii_grid).
     """
-
     # Open the ASCII grid file for reading
     with open(filename, 'r') as file:
         # Read the first six lines to get the header information
@@ -71,11 +490,87 @@ def read_ascii_grid(filename):
     cellsize = float(header[4].split()[1])   # Cell size
     nodata_value = float(header[5].split()[1])  # No data value
 
-    # Read the rest of the file to get the grid data, skipping the first six lines (header)
-    data = np.loadtxt(filename, skiprows=6)
+    return ncols, nrows, xllcorner, yllcorner, cellsize, nodata_value
+#%%
+
+def save_atomic(path, save, *args, **kwargs):
+    #%%
+    """
+    Saves a file through a unique temporary file in the same directory, which is then
+    renamed to path. Processes saving the same file at the same time never see a
+    partly written file, the last rename wins.
+
+    Parameters:
+    path (str): The path of the saved file.
+    save (callable): Writes the file as save(file, *args, **kwargs), e.g. np.save or np.savez.
+    *args, **kwargs: The arguments of save.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".",
+                                    suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            save(file, *args, **kwargs)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+#%%
+
+def read_ascii_grid(filename):
+    #%%
+    """
+    Reads an ASCII grid file and extracts the header information and data.
+    The parsed grid is cached in a .npy sidecar file next to the ASCII grid. The
+    sidecar is named after the modification time and size of the ASCII grid, so
+    that it is rebuilt whenever the ASCII grid changes.
+
+    Parameters:
+    filename (str): The path to the ASCII grid file.
+
+    Returns:
+    tuple: A tuple containing the following elements:
+        - ncols (int): Number of columns in the grid.
+        - nrows (int): Number of rows in the grid.
+        - xllcorner (float): X coordinate of the lower left corner.
+        - yllcorner (float): Y coordinate of the lower left corner.
+        - cellsize (float): Size of each cell.
+        - nodata_value (float): Value used to represent no data.
+        - data (ndarray): 2D array of grid data, read-only and memory-mapped from the sidecar,
+          in memory if the sidecar cannot be written.
+    """
+    ncols, nrows, xllcorner, yllcorner, cellsize, nodata_value = read_ascii_header(filename)
+
+    # The sidecar is valid if it was built from the same modification time and size
+    stat = os.stat(filename)
+    sidecar = "{}.{}-{}.npy".format(filename, stat.st_mtime_ns, stat.st_size)
+    if os.path.isfile(sidecar):
+        return ncols, nrows, xllcorner, yllcorner, cellsize, nodata_value, np.load(sidecar, mmap_mode='r')
+
+    # Parse the grid data after the six header lines in one pass
+    with open(filename, 'r') as file:
+        for _ in range(6):
+            file.readline()
+        data = np.fromstring(file.read(), dtype=float, sep=' ').reshape(nrows, ncols)
+
+    # Write the sidecar, it only appears once complete. Without write access to the
+    # directory of the grid, the parsed data is returned without a sidecar
+    try:
+        save_atomic(sidecar, np.save, data)
+    except OSError as e:
+        logger.warning(f"Could not write the sidecar of {filename}: {e}")
+        return ncols, nrows, xllcorner, yllcorner, cellsize, nodata_value, data
+
+    # Remove sidecars of former versions
+    for stale in glob.glob(glob.escape(filename) + ".*-*.npy"):
+        if stale != sidecar:
+            try:
+                os.remove(stale)
+            except OSError:  # Removed by another process
+                pass
 
     # Return the header information and data as a tuple
-    return ncols, nrows, xllcorner, yllcorner, cellsize, nodata_value, data
+    return ncols, nrows, xllcorner, yllcorner, cellsize, nodata_value, np.load(sidecar, mmap_mode='r')
 #%%
 
 def get_bounds_from_mask(mask_file_path):
@@ -89,8 +584,8 @@ def get_bounds_from_mask(mask_file_path):
     Returns:
     list: A list containing the bounding box coordinates [xmin, xmax, ymin, ymax].
     """
-    # Read the ASCII grid file to get its header information and data
-    ncols, nrows, xllcorner, yllcorner, cellsize, nodata_value, data = read_ascii_grid(mask_file_path)
+    # Read only the header of the ASCII grid file
+    ncols, nrows, xllcorner, yllcorner, cellsize, nodata_value = read_ascii_header(mask_file_path)
     
     # Calculate the minimum and maximum X coordinates
     xmin = xllcorner
@@ -104,6 +599,302 @@ def get_bounds_from_mask(mask_file_path):
     return [xmin, xmax, ymin, ymax]
 #%%
 
+def build_class_lut(scheme):
+    #%%
+    """
+    Builds a 256 entry uint8 lookup table from a reclassification scheme.
+
+    Parameters:
+    scheme (str or dict): The name of a scheme in CLASS_SCHEMES, or a {code: new code} mapping.
+
+    Returns:
+    ndarray: The lookup table, codes missing from the scheme map to themselves.
+    """
+    if isinstance(scheme, str):
+        scheme = CLASS_SCHEMES[scheme]
+    lut = np.arange(256, dtype=np.uint8)
+    for code, new_code in scheme.items():
+        lut[code] = new_code
+    return lut
+#%%
+
+def reclassify(data, scheme="all_classes"):
+    #%%
+    """
+    Reclassifies SWS class codes in one vectorized lookup, in place and without float promotion.
+
+    Parameters:
+    data (ndarray): The uint8 array of SWS class codes, modified in place.
+    scheme (str, dict or ndarray): A scheme name in CLASS_SCHEMES, a {code: new code} mapping
+                                   or a lookup table from build_class_lut.
+
+    Returns:
+    ndarray: The reclassified array (the same object as data).
+    """
+    lut = scheme if isinstance(scheme, np.ndarray) else build_class_lut(scheme)
+    np.take(lut, data, out=data, mode="clip")
+    return data
+#%%
+
+def scene_statistics(data, scheme="all_classes", mask=None):
+    #%%
+    """
+    Computes the class statistics of an SWS scene in a single bincount pass.
+
+    Parameters:
+    data (ndarray): The uint8 array of original SWS class codes (before reclassification).
+    scheme (str, dict or ndarray): The reclassification scheme the wet snow mean and sum
+                                   refer to, see reclassify.
+    mask (ndarray, optional): Boolean mask of the pixels to count, e.g. from aoi_mask.
+                              Default is all pixels.
+
+    Returns:
+    dict: A dictionary containing:
+        - wetsnow_mean (float): Mean of the reclassified values over the pixels that are not noData.
+        - wetsnow_sum (int): Sum of the reclassified values over the pixels that are not noData.
+        - <class>_count (int): Number of pixels of each class in SWS_CLASSES.
+        - <class>_fraction (float): Fraction of the scene pixels of each class in SWS_CLASSES.
+    """
+    # Count the pixels of every code in one pass
+    pixels = data.ravel() if mask is None else data[mask]
+    hist = np.bincount(pixels, minlength=256)
+    total = pixels.size
+
+    # Mean and sum of the reclassified values, noData (255) excluded
+    lut = scheme if isinstance(scheme, np.ndarray) else build_class_lut(scheme)
+    valid = lut != 255
+    valid_count = hist[valid].sum()
+    wetsnow_sum = int((hist[valid] * lut[valid]).sum())
+    wetsnow_mean = float(wetsnow_sum / valid_count) if valid_count else np.nan
+
+    stats = {"wetsnow_mean": wetsnow_mean, "wetsnow_sum": wetsnow_sum}
+    for name, code in SWS_CLASSES.items():
+        stats[f"{name}_count"] = int(hist[code])
+        stats[f"{name}_fraction"] = float(hist[code] / total) if total else np.nan
+    return stats
+#%%
+
+def composite_scenes(arrays, geotransforms, rule="valid_first", nodata=255):
+    #%%
+    """
+    Merges the clipped scenes of one day into a single array.
+
+    Parameters:
+    arrays (list): The uint8 arrays of original SWS class codes, ordered by sensing time.
+    geotransforms (list): The geotransforms of the arrays, which must all be the same.
+    rule (str): The merge rule:
+        - "latest": every pixel is taken from the most recent scene with valid data.
+        - "wet_wins": wet snow (110) wins if any scene is wet, otherwise as "valid_first".
+        - "valid_first": every pixel is taken from the earliest scene with valid data.
+    nodata (int, optional): The noData value. Default is 255.
+
+    Returns:
+    ndarray: The merged array of SWS class codes.
+
+    Raises:
+    ValueError: If the scenes are not on the same grid or the rule is unknown.
+    """
+    if any(list(geotrans) != list(geotransforms[0]) or data.shape != arrays[0].shape
+           for data, geotrans in zip(arrays, geotransforms)):
+        raise ValueError("The scenes of a day must be on the same grid to be merged.")
+    if rule not in ("latest", "wet_wins", "valid_first"):
+        raise ValueError(f"Unknown composite rule: {rule}")
+
+    # Fill the noData pixels of the first scene in priority order from the others
+    ordered = arrays[::-1] if rule == "latest" else arrays
+    composite = ordered[0].copy()
+    for data in ordered[1:]:
+        fill = composite == nodata
+        composite[fill] = data[fill]
+
+    if rule == "wet_wins":
+        wet = SWS_CLASSES["wet"]
+        for data in arrays:
+            composite[data == wet] = wet
+    return composite
+#%%
+
+# Zone indices already aligned in this process, by (zones file, geotransform, shape)
+_ZONE_INDICES = {}
+
+def zone_index(zones_path, geotrans, shape, projection):
+    #%%
+    """
+    Resamples the label grid of an ASCII grid file (e.g. mask_catchments_32632.asc) onto
+    a grid, e.g. the clipped AOI, with nearest neighbour, so that the label grid may have
+    any cell size and alignment. The label grid is taken to be in the projection of the
+    grid. The result is kept in memory.
+
+    Parameters:
+    zones_path (str): The path to the ASCII grid of zone labels.
+    geotrans (list): The geotransform of the grid.
+    shape (tuple): The (rows, columns) of the grid.
+    projection (osr.SpatialReference): The spatial reference system of the grid.
+
+    Returns:
+    tuple: A tuple containing:
+        - index (ndarray): The zone index (position in zones) of every pixel, -1 outside all zones.
+        - zones (ndarray): The sorted zone labels.
+    """
+    memo_key = (zones_path, tuple(geotrans), tuple(shape))
+    if memo_key in _ZONE_INDICES:
+        return _ZONE_INDICES[memo_key]
+
+    # Wrap the parsed labels (see read_ascii_grid) in an in-memory dataset
+    ncols, nrows, xllcorner, yllcorner, cellsize, nodata_value, labels = read_ascii_grid(zones_path)
+    src = gdal.GetDriverByName("MEM").Create("", ncols, nrows, 1, gdal.GDT_Float64)
+    src.SetGeoTransform([xllcorner, cellsize, 0.0, yllcorner + nrows * cellsize, 0.0, -cellsize])
+    src.SetProjection(projection.ExportToWkt())
+    src.GetRasterBand(1).SetNoDataValue(nodata_value)
+    src.GetRasterBand(1).WriteArray(np.asarray(labels))
+
+    # Resample the labels onto the grid, as dem_bands does with the DEM
+    res = geotrans[1]
+    bounds = [geotrans[0], geotrans[3] - shape[0] * res, geotrans[0] + shape[1] * res, geotrans[3]]
+    ds = gdal.Warp("", src, format="MEM", outputBounds=bounds, width=shape[1], height=shape[0],
+                   dstSRS=projection.ExportToWkt(), resampleAlg="near", srcNodata=nodata_value,
+                   dstNodata=nodata_value, outputType=gdal.GDT_Float64)
+    aligned = ds.GetRasterBand(1).ReadAsArray()
+
+    # Replace the labels by their position in the sorted zone labels
+    valid = aligned != nodata_value
+    zones = np.unique(aligned[valid])
+    index = np.full(shape, -1, dtype=np.int64)
+    index[valid] = np.searchsorted(zones, aligned[valid])
+
+    _ZONE_INDICES[memo_key] = (index, zones)
+    return index, zones
+#%%
+
+def zonal_statistics(data, index, zones):
+    #%%
+    """
+    Counts the pixels of every SWS class in every zone in one combined-index bincount pass.
+
+    Parameters:
+    data (ndarray): The uint8 array of original SWS class codes.
+    index (ndarray): The zone index of every pixel, -1 outside all zones, see zone_index.
+    zones (ndarray): The zone labels, see zone_index.
+
+    Returns:
+    list: Long format rows [zone, class, count, fraction], one per zone and class in SWS_CLASSES,
+          the fraction being relative to the pixels of the zone.
+    """
+    valid = index >= 0
+    counts = np.bincount(index[valid] * 256 + data[valid], minlength=len(zones) * 256)
+    counts = counts.reshape(len(zones), 256)
+    totals = counts.sum(axis=1)
+    return [
+        [zone.item(), name, int(counts[z, code]), float(counts[z, code] / totals[z]) if totals[z] else np.nan]
+        for z, zone in enumerate(zones)
+        for name, code in SWS_CLASSES.items()
+    ]
+#%%
+
+# Aspect classes of the banded statistics, clockwise from north in 45 degree sectors
+ASPECT_CLASSES = ["N", "NE", "E", "SE", "S", "SW", "W", "NW"]
+
+# Band indices already built in this process, by (DEM, geotransform, shape, band width)
+_DEM_BANDS = {}
+
+def dem_bands(dem_path, geotrans, shape, projection, cache_dir, band_width=250, flat_slope=2):
+    #%%
+    """
+    Builds the elevation band and aspect class of every pixel of a grid from a DEM.
+    The DEM is warped (bilinear) onto the grid, e.g. the clipped AOI. The band index
+    is cached on disk, keyed by the DEM file, the grid and the band width, and kept in memory.
+
+    Parameters:
+    dem_path (str): The path to the DEM, in any format readable by GDAL.
+    geotrans (list): The geotransform of the grid.
+    shape (tuple): The (rows, columns) of the grid.
+    projection (osr.SpatialReference): The spatial reference system of the grid.
+    cache_dir (str): The directory of the cached band indices.
+    band_width (float, optional): The height of the elevation bands in meters. Default is 250.
+    flat_slope (float, optional): Slopes below this angle in degrees are classed "flat". Default is 2.
+
+    Returns:
+    tuple: A tuple containing:
+        - index (ndarray): The band index (position in labels) of every pixel, -1 without DEM data.
+        - labels (list): The (elevation band lower bound, aspect class) of every band index.
+    """
+    memo_key = (dem_path, tuple(geotrans), tuple(shape), band_width, flat_slope)
+    if memo_key in _DEM_BANDS:
+        return _DEM_BANDS[memo_key]
+
+    # Look for the band index in the cache
+    stat = os.stat(dem_path)
+    key = hashlib.sha1(json.dumps([os.path.abspath(dem_path), stat.st_mtime_ns, stat.st_size, list(geotrans),
+                                   list(shape), band_width, flat_slope]).encode()).hexdigest()
+    cache_path = os.path.join(cache_dir, f"dem_bands_{key}.npz")
+    if os.path.isfile(cache_path):
+        cached = np.load(cache_path)
+        result = (cached["index"], [(float(e), str(a)) for e, a in zip(cached["elevations"], cached["aspects"])])
+        _DEM_BANDS[memo_key] = result
+        return result
+
+    # Warp the DEM onto the grid
+    res = geotrans[1]
+    bounds = [geotrans[0], geotrans[3] - shape[0] * res, geotrans[0] + shape[1] * res, geotrans[3]]
+    ds = gdal.Warp("", dem_path, format="MEM", outputBounds=bounds, width=shape[1], height=shape[0],
+                   dstSRS=projection.ExportToWkt(), resampleAlg="bilinear", dstNodata=np.nan,
+                   outputType=gdal.GDT_Float32)
+    elevation = ds.GetRasterBand(1).ReadAsArray().astype(float)
+    valid = np.isfinite(elevation)
+
+    # Slope and aspect (direction the slope faces, clockwise from north)
+    drow, dcol = np.gradient(np.where(valid, elevation, np.nanmean(elevation)), res)
+    dz_east, dz_north = dcol, -drow
+    slope = np.degrees(np.arctan(np.hypot(dz_east, dz_north)))
+    aspect = np.degrees(np.arctan2(-dz_east, -dz_north)) % 360
+    aspect_class = ((aspect + 22.5) // 45).astype(int) % 8
+    aspect_names = np.array(ASPECT_CLASSES + ["flat"])
+    aspect_class[slope < flat_slope] = len(ASPECT_CLASSES)
+
+    # Combine the elevation bands and aspect classes into one band index
+    band = np.floor(np.where(valid, elevation, 0) / band_width).astype(int)
+    combined = band * (len(ASPECT_CLASSES) + 1) + aspect_class
+    combined_labels = np.unique(combined[valid])
+    index = np.full(shape, -1, dtype=np.int64)
+    index[valid] = np.searchsorted(combined_labels, combined[valid])
+    elevations = (combined_labels // (len(ASPECT_CLASSES) + 1)) * band_width
+    aspects = aspect_names[combined_labels % (len(ASPECT_CLASSES) + 1)]
+
+    # Save the band index to the cache
+    os.makedirs(cache_dir, exist_ok=True)
+    save_atomic(cache_path, np.savez, index=index, elevations=elevations, aspects=aspects)
+
+    result = (index, [(float(e), str(a)) for e, a in zip(elevations, aspects)])
+    _DEM_BANDS[memo_key] = result
+    return result
+#%%
+
+def banded_statistics(data, index, labels, mask=None):
+    #%%
+    """
+    Counts the wet, dry and valid pixels of every elevation band and aspect class
+    in one combined-index bincount pass.
+
+    Parameters:
+    data (ndarray): The uint8 array of original SWS class codes.
+    index (ndarray): The band index of every pixel, -1 without DEM data, see dem_bands.
+    labels (list): The (elevation, aspect) of every band index, see dem_bands.
+    mask (ndarray, optional): Boolean mask of the pixels to count, e.g. from aoi_mask.
+
+    Returns:
+    list: Long format rows [elevation, aspect, wet, dry, valid], one per band.
+    """
+    valid = index >= 0 if mask is None else (index >= 0) & mask
+    counts = np.bincount(index[valid] * 256 + data[valid], minlength=len(labels) * 256)
+    counts = counts.reshape(len(labels), 256)
+    valid_counts = counts.sum(axis=1) - counts[:, SWS_CLASSES["nodata"]]
+    return [
+        [elevation, aspect, int(counts[b, SWS_CLASSES["wet"]]), int(counts[b, SWS_CLASSES["dry"]]),
+         int(valid_counts[b])]
+        for b, (elevation, aspect) in enumerate(labels)
+    ]
+#%%
+
 def df_from_dir(directory):
     #%%
     """
@@ -156,46 +947,27 @@ def writeLog(logfilepath, string, verbose=True):
     string (str): The message to be logged.
     verbose (bool): If True, prints the log entry to the console. Default is True.
     """
-    # Get the current date and time as a string (up to seconds)
-    timestring = str(dt.now())[0:19]
-
-    # Check if the log file already exists
-    if os.path.isfile(logfilepath):
-        # If the file exists, open it in append mode and write the log entry
-        with open(logfilepath, "a") as writefile:
-            writefile.write("\n{}: {}".format(timestring, string))
-    else:
-        # If the file does not exist, create it and write the log entry
-        with open(logfilepath, "w") as writefile:
-            writefile.write("\n{}: {}".format(timestring, string))
-
-    # If verbose is True, print the log entry to the console
-    if verbose:
-        print(string)
+    if not logger.handlers:
+        setup_logging(logfilepath)
+    # Queue the entry; the file is written in batches by the log listener
+    logger.info(string, extra={"console": verbose})
 #%%
 
-def clipArray(src_data, params, bound, log_path, offsetx=0, offsety=0):
+def getClipWindow(params, bound):
     #%%
     """
-    Clips a portion of a 2D array (representing raster data) based on the specified bounds.
+    Calculates the pixel window and geotransform of a clipping area on a source grid.
 
     Parameters:
-    src_data (ndarray): The source 2D array containing raster data.
-    params (tuple): A tuple containing the following elements:
-        - srcMinX (float): The minimum X coordinate of the source data.
-        - srcMaxY (float): The maximum Y coordinate of the source data.
-        - res (float): The resolution of the data (cell size).
-    bound (tuple): A tuple containing the clipping bounds:
-        - minX (float): The minimum X coordinate of the clipping area.
-        - maxX (float): The maximum X coordinate of the clipping area.
-        - minY (float): The minimum Y coordinate of the clipping area.
-        - maxY (float): The maximum Y coordinate of the clipping area.
-    offsetx (int, optional): The offset in the X direction. Default is 0.
-    offsety (int, optional): The offset in the Y direction. Default is 0.
+    params (tuple): A tuple containing srcMinX, srcMaxY and res of the source data (see clipArray).
+    bound (tuple): A tuple containing the clipping bounds (minX, maxX, minY, maxY).
 
     Returns:
     tuple: A tuple containing:
-        - clip (ndarray): The clipped portion of the source data.
+        - rowMin (int): The end row (exclusive) of the window.
+        - rowMax (int): The start row of the window.
+        - colMin (int): The start column of the window.
+        - colMax (int): The end column (exclusive) of the window.
         - geoTrans (list): The geotransform of the clipped data.
     """
     # Extract resolution and source bounds from parameters
@@ -209,20 +981,50 @@ def clipArray(src_data, params, bound, log_path, offsetx=0, offsety=0):
     minY = bound[2]
     maxY = bound[3]
 
-    # Calculate row and column indices for clipping
-    rowMin = int(math.ceil((srcMaxY - minY) / res))
-    rowMax = int(round((srcMaxY - maxY) / res))
-    colMin = int(round((minX - srcMinX) / res))
-    colMax = int(math.ceil((maxX - srcMinX) / res))
+    # Calculate row and column indices for clipping
+    rowMin = int(math.ceil((srcMaxY - minY) / res))
+    rowMax = int(round((srcMaxY - maxY) / res))
+    colMin = int(round((minX - srcMinX) / res))
+    colMax = int(math.ceil((maxX - srcMinX) / res))
+
+    # Calculate new geotransform for the clipped array
+    minXclip = srcMinX + colMin * res
+    maxYclip = srcMaxY - rowMax * res
+    geoTrans = [minXclip, res, 0, maxYclip, 0, -res]
+
+    return rowMin, rowMax, colMin, colMax, geoTrans
+#%%
+
+def clipArray(src_data, params, bound, log_path, offsetx=0, offsety=0):
+    #%%
+    """
+    Clips a portion of a 2D array (representing raster data) based on the specified bounds.
+
+    Parameters:
+    src_data (ndarray): The source 2D array containing raster data.
+    params (tuple): A tuple containing the following elements:
+        - srcMinX (float): The minimum X coordinate of the source data.
+        - srcMaxY (float): The maximum Y coordinate of the source data.
+        - res (float): The resolution of the data (cell size).
+    bound (tuple): A tuple containing the clipping bounds:
+        - minX (float): The minimum X coordinate of the clipping area.
+        - maxX (float): The maximum X coordinate of the clipping area.
+        - minY (float): The minimum Y coordinate of the clipping area.
+        - maxY (float): The maximum Y coordinate of the clipping area.
+    offsetx (int, optional): The offset in the X direction. Default is 0.
+    offsety (int, optional): The offset in the Y direction. Default is 0.
+
+    Returns:
+    tuple: A tuple containing:
+        - clip (ndarray): The clipped portion of the source data.
+        - geoTrans (list): The geotransform of the clipped data.
+    """
+    # Calculate row and column indices and geotransform for clipping
+    rowMin, rowMax, colMin, colMax, geoTrans = getClipWindow(params, bound)
 
     # Clip the array using calculated indices and offsets
     clip = src_data[rowMax + offsety:rowMin + offsety, colMin + offsetx:colMax + offsetx]
 
-    # Calculate new geotransform for the clipped array
-    minXclip = srcMinX + colMin * res
-    maxYclip = srcMaxY - rowMax * res
-    geoTrans = [minXclip, res, 0, maxYclip, 0, -res]
-
     # Log debug information
     debug_log(f"Clipping array with bounds: {bound}", log_path)
     debug_log(f"Clipped data shape: {clip.shape}", log_path)
@@ -258,6 +1060,69 @@ def getBounds_Shp(shapefile):
     return bounds
 #%%
 
+def shapefile_hash(shapefile):
+    #%%
+    """
+    Hashes the contents of a shapefile and its sidecar files (.shx, .dbf, .prj),
+    or of any other single file.
+    """
+    sha = hashlib.sha1()
+    base = os.path.splitext(shapefile)[0]
+    for ext in dict.fromkeys((os.path.splitext(shapefile)[1], ".shx", ".dbf", ".prj")):
+        if os.path.isfile(base + ext):
+            with open(base + ext, "rb") as f:
+                sha.update(f.read())
+    return sha.hexdigest()
+#%%
+
+# Masks already built in this process, by (shapefile, geotransform, shape)
+_AOI_MASKS = {}
+
+def aoi_mask(shapefile, geotrans, shape, projection, cache_dir):
+    #%%
+    """
+    Rasterizes the AOI polygons of a shapefile onto a grid as a boolean mask. The mask
+    is cached on disk, keyed by the shapefile hash and the grid, and kept in memory,
+    so that the geometry is only rasterized once.
+
+    Parameters:
+    shapefile (str): The path to the AOI shapefile.
+    geotrans (list): The geotransform of the grid, e.g. of the clipped AOI.
+    shape (tuple): The (rows, columns) of the grid.
+    projection (osr.SpatialReference): The spatial reference system of the grid.
+    cache_dir (str): The directory of the cached masks.
+
+    Returns:
+    ndarray: The boolean mask, True inside the AOI polygons.
+    """
+    memo_key = (shapefile, tuple(geotrans), tuple(shape))
+    if memo_key in _AOI_MASKS:
+        return _AOI_MASKS[memo_key]
+
+    # Look for the mask in the cache
+    key = hashlib.sha1(json.dumps([shapefile_hash(shapefile), list(geotrans), list(shape)]).encode()).hexdigest()
+    cache_path = os.path.join(cache_dir, f"aoi_mask_{key}.npy")
+    if os.path.isfile(cache_path):
+        mask = np.load(cache_path)
+    else:
+        # Rasterize the polygons onto an in-memory grid
+        shapeData = ogr.Open(shapefile, 0)
+        if not shapeData:
+            raise FileNotFoundError(f"Unable to open the shapefile: {shapefile}")
+        ds = gdal.GetDriverByName("MEM").Create("", shape[1], shape[0], 1, gdal.GDT_Byte)
+        ds.SetGeoTransform(list(geotrans))
+        ds.SetProjection(projection.ExportToWkt())
+        gdal.RasterizeLayer(ds, [1], shapeData.GetLayer(), burn_values=[1])
+        mask = ds.GetRasterBand(1).ReadAsArray().astype(bool)
+
+        # Save the mask to the cache
+        os.makedirs(cache_dir, exist_ok=True)
+        save_atomic(cache_path, np.save, mask)
+
+    _AOI_MASKS[memo_key] = mask
+    return mask
+#%%
+
 def getBounds_Raster(ds):
     #%%
     """
@@ -333,6 +1198,80 @@ def readRaster(filename):
     return data, geotrans, projection, bounds
 #%%
 
+def vsizip_path(zipfilepath, member):
+    #%%
+    """
+    Builds the GDAL virtual file system path of a file inside a ZIP archive,
+    so that it can be opened with GDAL without extracting it.
+
+    Parameters:
+    zipfilepath (str): The path to the ZIP archive.
+    member (str): The path of the file inside the archive.
+
+    Returns:
+    str: The /vsizip/ path of the file, e.g. /vsizip//data/SWS_x.zip/SWS_x/SWS_x_WSM.tif.
+    """
+    return "/vsizip/{}/{}".format(os.path.abspath(zipfilepath), member)
+#%%
+
+def readRasterWindow(filename, bound, log_path):
+    #%%
+    """
+    Reads only the part of a raster file covering the clipping bounds. Only the
+    compressed blocks intersecting the window are decoded, the result is the same
+    as readRaster followed by clipArray.
+
+    Parameters:
+    filename (str): The path to the raster file.
+    bound (tuple): A tuple containing the clipping bounds (minX, maxX, minY, maxY),
+                   e.g. from getBounds_Shp.
+    log_path (str): The path to the log file.
+
+    Returns:
+    tuple: A tuple containing:
+        - clip (ndarray): The clipped raster data as a 2D array.
+        - geoTrans (list): The geotransform of the clipped data.
+        - projection (osr.SpatialReference): The spatial reference system of the raster.
+        - bounds (list): The bounding box coordinates of the full raster [minX, maxX, minY, maxY].
+    """
+    # Open the raster file, for files inside zips this reads the zip directory
+    with profile_stage("open"):
+        ds = gdal.Open(filename)
+
+    if ds is None:
+        raise FileNotFoundError(f"Unable to open the raster file: {filename}")
+
+    # Calculate the pixel window of the clipping bounds
+    rowMin, rowMax, colMin, colMax, geoTrans = getClipWindow(getClipParams(ds), bound)
+
+    # Limit the window to the raster extent, as slicing does in clipArray
+    xoff = min(max(colMin, 0), ds.RasterXSize)
+    yoff = min(max(rowMax, 0), ds.RasterYSize)
+    xsize = max(min(colMax, ds.RasterXSize) - xoff, 0)
+    ysize = max(min(rowMin, ds.RasterYSize) - yoff, 0)
+
+    # Read the window of the first raster band (assuming the raster is single-band)
+    band = ds.GetRasterBand(1)
+    if xsize and ysize:
+        with profile_stage("decode"):
+            clip = band.ReadAsArray(xoff, yoff, xsize, ysize)
+    else:
+        clip = np.empty((ysize, xsize), dtype=gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+
+    # Retrieve the spatial reference system (projection)
+    projection = osr.SpatialReference()
+    projection.ImportFromWkt(ds.GetProjectionRef())
+
+    # Calculate the bounding box coordinates
+    bounds = getBounds_Raster(ds)
+
+    # Log debug information
+    debug_log(f"Reading window of {filename} with bounds: {bound}", log_path)
+    debug_log(f"Clipped data shape: {clip.shape}", log_path)
+
+    return clip, geoTrans, projection, bounds
+#%%
+
 def getClipParams(ds):
     #%%
     """
@@ -363,7 +1302,25 @@ def getClipParams(ds):
     return params
 #%%
 
-def write_grid(filename, data, geotrans, projection, log_path, driver="GTiff", dtype=None):
+# Output profiles of write_grid, as (driver, creation options). A driver of None uses
+# the driver argument of write_grid. {predictor} is 2 for integer and 3 for float grids,
+# {threads} the num_threads argument of write_grid.
+# "lzw": striped LZW, the layout written before the profiles
+# "deflate", "zstd": 256 x 256 tiles with a predictor, windowed reads decode only the
+#                    tiles they need, blocks are compressed on num_threads threads
+# "cog": Cloud Optimized GeoTIFF, tiled with nearest neighbour overviews for map rendering
+WRITE_PROFILES = {
+    "lzw": (None, ["COMPRESS=LZW"]),
+    "deflate": (None, ["TILED=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256", "COMPRESS=DEFLATE",
+                       "PREDICTOR={predictor}", "NUM_THREADS={threads}"]),
+    "zstd": (None, ["TILED=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256", "COMPRESS=ZSTD",
+                    "PREDICTOR={predictor}", "NUM_THREADS={threads}"]),
+    "cog": ("COG", ["BLOCKSIZE=256", "COMPRESS=DEFLATE", "PREDICTOR=YES", "OVERVIEWS=AUTO",
+                    "RESAMPLING=NEAREST", "NUM_THREADS={threads}"]),
+}
+
+def write_grid(filename, data, geotrans, projection, log_path, driver="GTiff", dtype=None,
+               output_profile="lzw", nodata=None, color_table=None, num_threads="ALL_CPUS"):
     #%%
     """
     Writes a raster grid to a file.
@@ -375,29 +1332,46 @@ def write_grid(filename, data, geotrans, projection, log_path, driver="GTiff", d
     projection (osr.SpatialReference): The spatial reference system of the raster.
     driver (str, optional): The GDAL driver to use for writing the file. Default is "GTiff".
     dtype (optional): The data type for the output raster. Default is gdalconst.GDT_Float32.
+    output_profile (str, optional): The layout and compression of the file, see WRITE_PROFILES.
+                                    Default is "lzw".
+    nodata (float, optional): The noData value of the raster, e.g. 255 for SWS grids. Default is None.
+    color_table (gdal.ColorTable, optional): The colour table of Byte grids, see build_color_table.
+                                             Default is None.
+    num_threads (int or str, optional): The number of compression threads of the tiled profiles.
+                                        Use 1 in parallel worker processes. Default is "ALL_CPUS".
 
     Raises:
     ValueError: If the specified driver is not available or if dataset creation fails.
     """
     # Log the process of writing the grid
     debug_log(f"Writing grid to file: {filename}", log_path)
-    debug_log(f"Data shape: {data.shape}, Geotransform: {geotrans}, Projection: {projection.ExportToWkt()}", log_path)
+    if logger.isEnabledFor(logging.DEBUG):  # Skip the WKT export unless it is logged
+        debug_log(f"Data shape: {data.shape}, Geotransform: {geotrans}, Projection: {projection.ExportToWkt()}", log_path)
 
     # Set the default data type if not provided
     if dtype is None:
         dtype = gdalconst.GDT_Float32
 
-    # Get the GDAL driver by name
-    driver = gdal.GetDriverByName(driver)
+    # Get the GDAL driver and creation options of the output profile
+    profile_driver, options = WRITE_PROFILES[output_profile]
+    driver_name = profile_driver or driver
+    predictor = 3 if dtype in (gdalconst.GDT_Float32, gdalconst.GDT_Float64) else 2
+    options = [option.format(predictor=predictor, threads=num_threads) for option in options]
+    driver = gdal.GetDriverByName(driver_name)
     if driver is None:
-        debug_log("Driver GTiff is not available.", log_path)
-        raise ValueError("Driver GTiff is not available.")
+        debug_log(f"Driver {driver_name} is not available.", log_path)
+        raise ValueError(f"Driver {driver_name} is not available.")
 
     # Log the creation of the file with specified dimensions
     debug_log(f"Creating file with dimensions: {data.shape[1]}, {data.shape[0]}", log_path)
 
-    # Create the output dataset with the specified dimensions, data type, and compression
-    ds = driver.Create(filename, data.shape[1], data.shape[0], 1, dtype, ["COMPRESS=LZW"])
+    # Create the output dataset with the specified dimensions, data type, and compression.
+    # Drivers that cannot create files directly (COG) copy a dataset built in memory
+    direct = driver.GetMetadataItem(gdal.DCAP_CREATE) == "YES"
+    if direct:
+        ds = driver.Create(filename, data.shape[1], data.shape[0], 1, dtype, options)
+    else:
+        ds = gdal.GetDriverByName("MEM").Create("", data.shape[1], data.shape[0], 1, dtype)
     if ds is None:
         debug_log("Failed to create the dataset.", log_path)
         raise ValueError("Failed to create the dataset.")
@@ -406,13 +1380,27 @@ def write_grid(filename, data, geotrans, projection, log_path, driver="GTiff", d
     ds.SetGeoTransform(geotrans)
     ds.SetProjection(projection.ExportToWkt())
 
-    # Write the raster data to the dataset
-    ds.GetRasterBand(1).WriteArray(data)
+    # Set the noData value and colour table, and write the raster data to the dataset
+    band = ds.GetRasterBand(1)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    if color_table is not None:
+        band.SetRasterColorTable(color_table)
+    band.WriteArray(data)
+
+    # Copy the in-memory dataset to the output file, building the overviews of a COG
+    if not direct:
+        copy = driver.CreateCopy(filename, ds, options=options)
+        if copy is None:
+            debug_log("Failed to create the dataset.", log_path)
+            raise ValueError("Failed to create the dataset.")
+        copy = None
 
     # Log the completion of the writing process
     debug_log("Finished writing the grid.", log_path)
 
     # Properly close and flush the dataset
+    band = None
     del ds
 #%%
 
@@ -456,12 +1444,616 @@ def clear_temp_directory(temp_directory):
     """
     # Create a list of all files in the temporary directory
     files = glob.glob(os.path.join(temp_directory, "*"))
+    removed = 0
     for f in files:
         try:
             os.remove(f)
-            print(f"Removed file: {f}")
+            removed += 1
         except Exception as e:
-            print(f"Failed to remove {f}: {e}")
+            logger.warning(f"Failed to remove {f}: {e}")
+    # Log a single summary line instead of one line per file
+    logger.info(f"Removed {removed} of {len(files)} files from {temp_directory}")
+#%%
+
+
+#### Processing manifest ######################################################
+
+# Version of the processing code stored in the manifest. Increase it whenever the
+# processing changes, so that previously processed scenes are recomputed.
+PROCESSING_VERSION = "1"
+
+def open_manifest(manifest_path):
+    #%%
+    """
+    Opens the SQLite processing manifest, creating it if needed. Scene statistics
+    and processed days are keyed by AOI hash, class scheme hash and PROCESSING_VERSION.
+
+    Parameters:
+    manifest_path (str): The path to the manifest file.
+
+    Returns:
+    sqlite3.Connection: The connection to the manifest.
+    """
+    # Long timeout and WAL journal, as parallel workers write to the same manifest
+    manifest = sqlite3.connect(manifest_path, timeout=60)
+    manifest.execute("PRAGMA journal_mode=WAL")
+    with manifest:
+        manifest.executescript("""
+            CREATE TABLE IF NOT EXISTS scenes (
+                scene TEXT, aoi_hash TEXT, scheme_hash TEXT, code_version TEXT,
+                stats TEXT, processed TEXT,
+                PRIMARY KEY (scene, aoi_hash, scheme_hash, code_version));
+            CREATE TABLE IF NOT EXISTS days (
+                outfile TEXT, aoi_hash TEXT, scheme_hash TEXT, composite_rule TEXT,
+                code_version TEXT, written INTEGER, processed TEXT,
+                PRIMARY KEY (outfile, aoi_hash, scheme_hash, composite_rule, code_version));
+        """)
+    return manifest
+#%%
+
+def aoi_hash(bounds, mask_key=None):
+    #%%
+    """
+    Hashes the AOI bounds (minX, maxX, minY, maxY) for the processing manifest, together
+    with a key of the other inputs of the statistics, e.g. the hash of the AOI shapefile
+    if the statistics use the AOI mask (see shapefile_hash).
+    """
+    return hashlib.sha1(json.dumps([[float(b) for b in bounds], mask_key]).encode()).hexdigest()
+#%%
+
+def scheme_hash(scheme):
+    #%%
+    """
+    Hashes the lookup table of a reclassification scheme for the processing manifest,
+    so that a changed mapping is detected even if the scheme name stays the same.
+    """
+    lut = scheme if isinstance(scheme, np.ndarray) else build_class_lut(scheme)
+    return hashlib.sha1(lut.tobytes()).hexdigest()
+#%%
+
+def manifest_get_scene(manifest, scene, aoi_key, scheme_key):
+    #%%
+    """
+    Looks up the statistics of a processed scene in the manifest.
+
+    Parameters:
+    manifest (sqlite3.Connection): The manifest, see open_manifest.
+    scene (str): The scene name.
+    aoi_key (str): The AOI hash, see aoi_hash.
+    scheme_key (str): The class scheme hash, see scheme_hash.
+
+    Returns:
+    tuple: A tuple containing:
+        - found (bool): True if the scene was processed with the same AOI, scheme and code version.
+        - stats (dict): The scene statistics, None for scenes containing only NaN values.
+    """
+    row = manifest.execute(
+        "SELECT stats FROM scenes WHERE scene = ? AND aoi_hash = ? AND scheme_hash = ? AND code_version = ?",
+        (scene, aoi_key, scheme_key, PROCESSING_VERSION)).fetchone()
+    if row is None:
+        return False, None
+    return True, json.loads(row[0])
+#%%
+
+def manifest_put_scene(manifest, scene, aoi_key, scheme_key, stats):
+    #%%
+    """
+    Commits the statistics of a processed scene to the manifest (None for scenes
+    containing only NaN values).
+    """
+    with manifest:
+        manifest.execute(
+            "INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?, ?)",
+            (scene, aoi_key, scheme_key, PROCESSING_VERSION, json.dumps(stats), str(dt.now())[0:19]))
+#%%
+
+def manifest_get_day(manifest, outfile, aoi_key, scheme_key, composite_rule):
+    #%%
+    """
+    Looks up a processed day in the manifest.
+
+    Returns:
+    bool: None if the day was not processed with the same AOI, scheme, composite rule and
+          code version, otherwise whether an output file was written for the day.
+    """
+    row = manifest.execute(
+        "SELECT written FROM days WHERE outfile = ? AND aoi_hash = ? AND scheme_hash = ? "
+        "AND composite_rule = ? AND code_version = ?",
+        (outfile, aoi_key, scheme_key, composite_rule, PROCESSING_VERSION)).fetchone()
+    return None if row is None else bool(row[0])
+#%%
+
+def manifest_put_day(manifest, outfile, aoi_key, scheme_key, composite_rule, written):
+    #%%
+    """
+    Commits a processed day to the manifest, with whether an output file was written.
+    """
+    with manifest:
+        manifest.execute(
+            "INSERT OR REPLACE INTO days VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (outfile, aoi_key, scheme_key, composite_rule, PROCESSING_VERSION, int(written),
+             str(dt.now())[0:19]))
+#%%
+
+
+#### Results store ############################################################
+
+def season_of(date):
+    #%%
+    """
+    Returns the snow season of a date. Seasons run from October to September,
+    e.g. 2018-11-02 and 2019-05-20 both belong to season "2018_2019".
+    """
+    start_year = date.year if date.month >= 10 else date.year - 1
+    return f"{start_year}_{start_year + 1}"
+#%%
+
+def append_results(store_path, df):
+    #%%
+    """
+    Appends result records to the results store, a Parquet dataset partitioned by
+    snow season (store_path/season=2018_2019/part-*.parquet). Every call writes new
+    part files only, the records already stored are never rewritten.
+
+    Parameters:
+    store_path (str): The path to the results store directory.
+    df (DataFrame): The records to append, with a datetime "Date" column.
+    """
+    if df.empty:
+        return
+    df = df.copy()
+    df["Date"] = pd.to_datetime(df["Date"])
+    # Time of writing, the latest record of a date wins when loading
+    df["processed"] = pd.Timestamp(dt.now())
+    stamp = dt.now().strftime("%Y%m%dT%H%M%S%f")
+    for season, season_df in df.groupby(df["Date"].map(season_of)):
+        season_dir = os.path.join(store_path, f"season={season}")
+        os.makedirs(season_dir, exist_ok=True)
+        season_df.to_parquet(os.path.join(season_dir, f"part-{stamp}.parquet"), index=False)
+#%%
+
+def load_results(store_path, seasons=None, keys=("Date",)):
+    #%%
+    """
+    Loads the results store written by append_results.
+
+    Parameters:
+    store_path (str): The path to the results store directory.
+    seasons (list, optional): The seasons to load, e.g. ["2018_2019"]. Default is all seasons.
+    keys (tuple, optional): The columns identifying a record, e.g. ("Date", "zone", "class")
+                            for long format tables. Default is ("Date",).
+
+    Returns:
+    DataFrame: The records indexed by keys in date order, keeping the latest record of each key.
+    """
+    files = sorted(glob.glob(os.path.join(store_path, "season=*", "*.parquet")))
+    if seasons is not None:
+        files = [f for f in files if os.path.basename(os.path.dirname(f))[len("season="):] in seasons]
+    if not files:
+        return pd.DataFrame(columns=list(keys)).set_index(list(keys))
+
+    df = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+    df = df.sort_values(list(keys) + ["processed"]).drop_duplicates(list(keys), keep="last")
+    return df.drop(columns="processed").set_index(list(keys))
+#%%
+
+
+#### Data cube ################################################################
+
+def append_to_cube(cube_path, frame_time, data, geotrans, projection):
+    #%%
+    """
+    Appends a clipped AOI array to the data cube, a (time, y, x) uint8 store made of a
+    raw, memory-mappable data file (data.u8) and a metadata file (cube.json) holding the
+    time coordinate, the AOI geotransform and the projection. Frames are stored in the
+    order they are appended, a time that is already in the cube is skipped.
+
+    Parameters:
+    cube_path (str): The path to the data cube directory.
+    frame_time (datetime): The time of the array.
+    data (ndarray): The 2D uint8 array to append.
+    geotrans (list): The geotransform of the array.
+    projection (str): The projection of the array as WKT.
+
+    Raises:
+    ValueError: If the array does not match the shape or grid of the cube.
+    """
+    os.makedirs(cube_path, exist_ok=True)
+    meta_path = os.path.join(cube_path, "cube.json")
+    frame_time = pd.Timestamp(frame_time).isoformat()
+
+    # Read the cube metadata, or start a new cube on the grid of the array
+    if os.path.isfile(meta_path):
+        with open(meta_path, "r") as meta_file:
+            meta = json.load(meta_file)
+        if list(data.shape) != meta["shape"] or list(geotrans) != meta["geotransform"]:
+            raise ValueError(f"Array of {frame_time} does not match the grid of the cube {cube_path}")
+        if frame_time in meta["times"]:
+            return
+    else:
+        meta = {"shape": list(data.shape), "dtype": "uint8", "geotransform": list(geotrans),
+                "projection": projection, "times": []}
+
+    # Write the frame at the position of its time, discarding the bytes of an interrupted append
+    frame_size = data.shape[0] * data.shape[1]
+    with open(os.path.join(cube_path, "data.u8"), "ab") as data_file:
+        data_file.truncate(len(meta["times"]) * frame_size)
+        data_file.write(np.ascontiguousarray(data, dtype=np.uint8).tobytes())
+
+    # Update the metadata last, so that a frame only counts once it is fully written
+    meta["times"].append(frame_time)
+    with open(meta_path + ".tmp", "w") as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(meta_path + ".tmp", meta_path)
+#%%
+
+def open_cube(cube_path):
+    #%%
+    """
+    Opens the data cube written by append_to_cube as a read-only memory map.
+
+    Parameters:
+    cube_path (str): The path to the data cube directory.
+
+    Returns:
+    tuple: A tuple containing:
+        - data (np.memmap): The (time, y, x) uint8 array of the cube.
+        - times (DatetimeIndex): The time coordinate, in append order.
+        - geotrans (list): The geotransform of the AOI.
+        - projection (str): The projection of the AOI as WKT.
+    """
+    with open(os.path.join(cube_path, "cube.json"), "r") as meta_file:
+        meta = json.load(meta_file)
+    shape = (len(meta["times"]), meta["shape"][0], meta["shape"][1])
+    if shape[0] == 0:
+        data = np.zeros(shape, dtype=np.uint8)
+    else:
+        data = np.memmap(os.path.join(cube_path, "data.u8"), dtype=np.uint8, mode="r", shape=shape)
+    return data, pd.DatetimeIndex(meta["times"]), meta["geotransform"], meta["projection"]
+#%%
+
+def cube_times(cube_path):
+    #%%
+    """
+    Returns the times of the frames in the data cube, without opening its data.
+
+    Parameters:
+    cube_path (str): The path to the data cube directory.
+
+    Returns:
+    set: The times as ISO strings, as stored by append_to_cube. Empty if there is no cube yet.
+    """
+    meta_path = os.path.join(cube_path, "cube.json")
+    if not os.path.isfile(meta_path):
+        return set()
+    with open(meta_path, "r") as meta_file:
+        return set(json.load(meta_file)["times"])
+#%%
+
+
+def build_pixel_index(cube_path, block_size=256 * 1024 * 1024):
+    #%%
+    """
+    Builds the time-major copy of the data cube used for point queries: a (y, x, time)
+    uint8 array (pixels.u8) in which the full time series of each pixel is contiguous,
+    sorted by time, and its metadata (pixels.json). The cube is transposed in blocks
+    of rows so that memory stays bounded.
+
+    Parameters:
+    cube_path (str): The path to the data cube directory, see append_to_cube.
+    block_size (int, optional): The max number of bytes transposed at once. Default is 256 MB.
+    """
+    data, times, geotrans, projection = open_cube(cube_path)
+    ntimes, nrows, ncols = data.shape
+    order = np.argsort(times.values, kind="stable")
+    rows_per_block = max(1, block_size // max(ntimes * ncols, 1))
+
+    # Write the transposed blocks, then the metadata so that the index only counts once complete
+    pixels_path = os.path.join(cube_path, "pixels.u8")
+    with open(pixels_path + ".tmp", "wb") as pixels_file:
+        for row in range(0, nrows, rows_per_block):
+            block = data[:, row:row + rows_per_block, :][order]
+            pixels_file.write(np.ascontiguousarray(block.transpose(1, 2, 0)).tobytes())
+    os.replace(pixels_path + ".tmp", pixels_path)
+    with open(os.path.join(cube_path, "pixels.json"), "w") as meta_file:
+        json.dump({"times": [t.isoformat() for t in times[order]]}, meta_file)
+#%%
+
+def query_points(cube_path, xs, ys, names=None):
+    #%%
+    """
+    Returns the class time series of points of the AOI from the time-major pixel index,
+    rebuilding the index first if it is missing or older than the data cube.
+
+    Parameters:
+    cube_path (str): The path to the data cube directory, see append_to_cube.
+    xs (list): The X coordinates of the points, in the AOI CRS.
+    ys (list): The Y coordinates of the points, in the AOI CRS.
+    names (list, optional): The column names of the points. Default is "x_y".
+
+    Returns:
+    DataFrame: The class values indexed by time, one column per point.
+
+    Raises:
+    ValueError: If a point lies outside the AOI.
+    """
+    with open(os.path.join(cube_path, "cube.json"), "r") as meta_file:
+        meta = json.load(meta_file)
+    meta_path = os.path.join(cube_path, "pixels.json")
+    times = []
+    if os.path.isfile(meta_path):
+        with open(meta_path, "r") as index_file:
+            times = json.load(index_file)["times"]
+    if len(times) != len(meta["times"]):
+        build_pixel_index(cube_path)
+        with open(meta_path, "r") as index_file:
+            times = json.load(index_file)["times"]
+
+    # Convert the coordinates to pixel indices with the AOI geotransform
+    geotrans = meta["geotransform"]
+    nrows, ncols = meta["shape"]
+    cols = np.floor((np.asarray(xs, dtype=float) - geotrans[0]) / geotrans[1]).astype(int)
+    rows = np.floor((np.asarray(ys, dtype=float) - geotrans[3]) / geotrans[5]).astype(int)
+    if np.any((cols < 0) | (cols >= ncols) | (rows < 0) | (rows >= nrows)):
+        raise ValueError("Points outside of the AOI can not be queried.")
+
+    # Read the contiguous time series of every point
+    if names is None:
+        names = [f"{x}_{y}" for x, y in zip(xs, ys)]
+    if times:
+        pixels = np.memmap(os.path.join(cube_path, "pixels.u8"), dtype=np.uint8, mode="r",
+                           shape=(nrows, ncols, len(times)))
+        series = pixels[rows, cols, :].T
+    else:
+        series = np.zeros((0, len(names)), dtype=np.uint8)
+    return pd.DataFrame(series, index=pd.DatetimeIndex(times, name="Date"), columns=names)
+#%%
+
+
+#### Temporal statistics ######################################################
+
+def iter_daily_rasters(directory):
+    #%%
+    """
+    Iterates over the processed daily rasters (SWS_YYYY_MM_DD_HH_MM.tif) of a directory
+    in time order, reading one raster at a time.
+
+    Parameters:
+    directory (str): The directory containing the processed daily rasters.
+
+    Yields:
+    tuple: (time, data, geotrans, projection) of each raster.
+    """
+    files = glob.glob(os.path.join(directory, "SWS_*.tif"))
+    times = [dt.strptime(os.path.basename(f)[4:20], "%Y_%m_%d_%H_%M") for f in files]
+    for frame_time, filename in sorted(zip(times, files)):
+        data, geotrans, projection, bounds = readRaster(filename)
+        yield frame_time, data, geotrans, projection
+#%%
+
+def iter_cube_frames(cube_path):
+    #%%
+    """
+    Iterates over the frames of the data cube (see append_to_cube) in time order.
+
+    Parameters:
+    cube_path (str): The path to the data cube directory.
+
+    Yields:
+    tuple: (time, data, geotrans, projection) of each frame.
+    """
+    data, times, geotrans, wkt = open_cube(cube_path)
+    projection = osr.SpatialReference()
+    projection.ImportFromWkt(wkt)
+    for index in np.argsort(times.values, kind="stable"):
+        yield times[index], np.asarray(data[index]), geotrans, projection
+#%%
+
+def temporal_statistics(frames, output_directory, log_path, wet=1, nodata=255):
+    #%%
+    """
+    Reduces a time ordered stream of daily rasters to per-pixel temporal products,
+    keeping only running per-pixel state so that memory does not grow with the
+    number of days. Days run within each snow season (see season_of) and are
+    counted from October 1st. Observations without valid data are skipped.
+
+    Written per season, as <season>_<product>.tif in output_directory:
+    - wet_frequency (Float32): wet observations / valid observations, NaN without valid data.
+    - first_wet, last_wet (Int16): day of season of the first / last wet observation, -1 if never wet.
+    - longest_wet_spell (Int16): longest run of consecutive wet observations, -1 without valid data.
+    - max_wet_extent (Byte): 1 if wet at least once, 0 if never wet, 255 without valid data.
+    Written per month, as <YYYY_MM>_max_wet_extent.tif:
+    - max_wet_extent (Byte): as above, within the month.
+
+    Parameters:
+    frames (iterable): (time, data, geotrans, projection) tuples in time order,
+                       e.g. from iter_daily_rasters or iter_cube_frames.
+    output_directory (str): The directory the products are written to.
+    log_path (str): The path to the log file.
+    wet (int, optional): The wet snow value of the rasters. Default is 1.
+    nodata (int, optional): The noData value of the rasters. Default is 255.
+
+    Returns:
+    list: The paths of the written files.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    written = []
+    season = month = None
+    state = {}
+
+    def write_product(name, data, dtype):
+        filename = os.path.join(output_directory, f"{name}.tif")
+        write_grid(filename, data, state["geotrans"], state["projection"], log_path, dtype=dtype)
+        written.append(filename)
+
+    def flush_month():
+        write_product(f"{month}_max_wet_extent", state["month_extent"], gdal.GDT_Byte)
+
+    def flush_season():
+        no_valid = state["valid_count"] == 0
+        frequency = state["wet_count"] / np.maximum(state["valid_count"], 1)
+        frequency = frequency.astype(np.float32)
+        frequency[no_valid] = np.nan
+        state["longest"][no_valid] = -1
+        write_product(f"{season}_wet_frequency", frequency, gdal.GDT_Float32)
+        write_product(f"{season}_first_wet", state["first_wet"], gdal.GDT_Int16)
+        write_product(f"{season}_last_wet", state["last_wet"], gdal.GDT_Int16)
+        write_product(f"{season}_longest_wet_spell", state["longest"], gdal.GDT_Int16)
+        write_product(f"{season}_max_wet_extent", state["season_extent"], gdal.GDT_Byte)
+
+    for frame_time, data, geotrans, projection in frames:
+        frame_time = pd.Timestamp(frame_time)
+        time_season = season_of(frame_time)
+        time_month = frame_time.strftime("%Y_%m")
+
+        # Write the products of a completed month or season and reset their state
+        if month is not None and time_month != month:
+            flush_month()
+        if season is not None and time_season != season:
+            flush_season()
+        if time_month != month:
+            state["month_extent"] = np.full(data.shape, nodata, dtype=np.uint8)
+            month = time_month
+        if time_season != season:
+            state.update({
+                "geotrans": geotrans,
+                "projection": projection,
+                "start": pd.Timestamp(int(time_season[0:4]), 10, 1),
+                "wet_count": np.zeros(data.shape, dtype=np.int32),
+                "valid_count": np.zeros(data.shape, dtype=np.int32),
+                "first_wet": np.full(data.shape, -1, dtype=np.int16),
+                "last_wet": np.full(data.shape, -1, dtype=np.int16),
+                "spell": np.zeros(data.shape, dtype=np.int16),
+                "longest": np.zeros(data.shape, dtype=np.int16),
+                "season_extent": np.full(data.shape, nodata, dtype=np.uint8),
+            })
+            season = time_season
+
+        # Update the running state with the observation
+        valid = data != nodata
+        is_wet = data == wet
+        day = (frame_time.normalize() - state["start"]).days
+        state["wet_count"] += is_wet
+        state["valid_count"] += valid
+        state["first_wet"][is_wet & (state["first_wet"] < 0)] = day
+        state["last_wet"][is_wet] = day
+        state["spell"][is_wet] += 1
+        state["spell"][valid & ~is_wet] = 0
+        np.maximum(state["longest"], state["spell"], out=state["longest"])
+        for extent in (state["month_extent"], state["season_extent"]):
+            extent[valid & (extent == nodata)] = 0
+            extent[is_wet] = 1
+
+    # Write the products of the last month and season
+    if month is not None:
+        flush_month()
+        flush_season()
+    return written
+#%%
+
+
+#### Synthetic SWS archives ###################################################
+
+# Share of each SWS class code in a synthetic scene, wet and dry snow are split by season
+SYNTHETIC_CLASS_SHARES = {
+    "snow": 0.50,            # Wet and dry snow
+    "shadow_layover": 0.08,
+    "water": 0.02,
+    "forest": 0.22,
+    "urban": 0.03,
+    "non_mountain": 0.15,
+}
+
+# Upper left corner of the Sentinel-2 tile T32TPT in EPSG:32632, and the 60 m SWS resolution
+SYNTHETIC_TILE_ORIGIN = (600000.0, 5300040.0)
+SYNTHETIC_RESOLUTION = 60.0
+
+
+def synthetic_scene(rng, size, date, patch_size=32):
+    #%%
+    """
+    Creates the SWS codes of a synthetic scene. Classes form patches of patch_size
+    pixels, as in real scenes, so that the scene compresses like a real product.
+    The wet share of the snow follows the snow season, peaking in late spring, and
+    a random strip at the swath edge has no data.
+
+    Parameters:
+    rng (Generator): The NumPy random generator.
+    size (int): The number of rows and columns of the scene, 1830 for a full tile.
+    date (datetime): The sensing date of the scene.
+    patch_size (int): The size of the class patches in pixels. Default is 32.
+
+    Returns:
+    ndarray: The scene as a 2D uint8 array of SWS class codes.
+    """
+    # Share of wet snow in the snow, from about 2% in winter to 70% in May
+    wet_share = 0.02 + 0.68 * max(0.0, math.sin(math.pi * (date.timetuple().tm_yday - 60) / 150))
+
+    # Draw the class of every patch
+    codes = [SWS_CLASSES["wet"], SWS_CLASSES["dry"]] + [SWS_CLASSES[name] for name in list(SYNTHETIC_CLASS_SHARES)[1:]]
+    shares = [SYNTHETIC_CLASS_SHARES["snow"] * wet_share, SYNTHETIC_CLASS_SHARES["snow"] * (1 - wet_share)] \
+        + list(SYNTHETIC_CLASS_SHARES.values())[1:]
+    patches = -(-size // patch_size)
+    coarse = rng.choice(np.array(codes, dtype=np.uint8), size=(patches, patches), p=shares)
+    data = np.repeat(np.repeat(coarse, patch_size, axis=0), patch_size, axis=1)[:size, :size]
+
+    # Wet and dry snow mix at the pixel level along the patch borders
+    snow = (data == SWS_CLASSES["wet"]) | (data == SWS_CLASSES["dry"])
+    flip = snow & (rng.random((size, size)) < 0.1)
+    data[flip] = np.where(data[flip] == SWS_CLASSES["wet"], SWS_CLASSES["dry"], SWS_CLASSES["wet"])
+
+    # No data outside the swath
+    data[:, size - int(rng.uniform(0, 0.3) * size):] = 255
+    return data
+#%%
+
+def write_synthetic_archive(directory, n_scenes, log_path, size=1830, start="2018-01-01", seed=0):
+    #%%
+    """
+    Writes an archive of synthetic SWS products for offline benchmarking. The zips are
+    named like real products, e.g. SWS_20180101T170648_S1A_T32TPT_V101_1.zip, and
+    contain the scene as <scene>/<scene>_WSM.tif. Scenes are acquired every day,
+    alternating between the morning and evening pass of Sentinel-1A and -1B.
+    The archive is the same for the same arguments, zips that exist already are kept.
+
+    Parameters:
+    directory (str): The directory to write the zips to.
+    n_scenes (int): The number of scenes of the archive.
+    log_path (str): The path to the log file.
+    size (int): The number of rows and columns of the scenes. Default is 1830, a full tile.
+    start (str): The date of the first scene. Default is "2018-01-01".
+    seed (int): The seed of the random generator. Default is 0.
+
+    Returns:
+    list: The paths of the zips of the archive, in time order.
+    """
+    os.makedirs(directory, exist_ok=True)
+    projection = osr.SpatialReference()
+    projection.ImportFromEPSG(32632)
+    geotrans = (SYNTHETIC_TILE_ORIGIN[0], SYNTHETIC_RESOLUTION, 0.0,
+                SYNTHETIC_TILE_ORIGIN[1], 0.0, -SYNTHETIC_RESOLUTION)
+
+    zipfiles = []
+    for i in range(n_scenes):
+        # Morning descending and evening ascending passes of both satellites
+        date = pd.Timestamp(start) + pd.Timedelta(days=i)
+        date += pd.Timedelta(hours=5, minutes=27, seconds=8) if i % 2 else pd.Timedelta(hours=17, minutes=6, seconds=48)
+        scene_name = "SWS_{}_{}_T32TPT_V101_1".format(date.strftime("%Y%m%dT%H%M%S"), "S1B" if i % 4 >= 2 else "S1A")
+        zipfilepath = os.path.join(directory, scene_name + ".zip")
+        zipfiles.append(zipfilepath)
+        if os.path.isfile(zipfilepath):
+            continue
+
+        # One generator per scene, so that every scene is the same whatever n_scenes is
+        data = synthetic_scene(np.random.default_rng([seed, i]), size, date)
+        with tempfile.TemporaryDirectory(dir=directory) as scratch:
+            tif_path = os.path.join(scratch, scene_name + "_WSM.tif")
+            write_grid(tif_path, data, geotrans, projection, log_path, dtype=gdal.GDT_Byte)
+            # Write to a temporary name first, an interrupted run leaves no broken zip
+            with zipfile.ZipFile(zipfilepath + ".tmp", "w", zipfile.ZIP_DEFLATED) as archive:
+                archive.write(tif_path, "{}/{}_WSM.tif".format(scene_name, scene_name))
+            os.replace(zipfilepath + ".tmp", zipfilepath)
+    return zipfiles
 #%%
 
 
@@ -521,13 +2113,7 @@ def process_and_plot_tif_all_classes(file_path, output_directory):
     data = band.ReadAsArray()
 
     # Replace specific values in the data
-    data[data == 110] = 1
-    data[data == 125] = 0
-    data[data == 200] = 21
-    data[data == 210] = 22
-    data[data == 220] = 23
-    data[data == 230] = 24
-    data[data == 240] = 25
+    reclassify(data, "all_classes")
 
     # Convert the array to float type
     data = data.astype(float)
@@ -1,22 +1,15 @@
 # -*- coding: utf-8 -*-
 
-import pandas as pd
 import matplotlib.pyplot as plt
+from functions_sentinel import load_results
 
 
-# Define the path to the CSV file
-path_to_file = "/home/luis/Data/04_Uni/03_Master_Thesis/SNOW/02_data/Sentinel_Data/SWS/SWS_analytics/df_datestamp_20180101_to_20240622.csv"
+# Define the path to the results store written by run_SWS_processing.py
+path_to_store = "/home/luis/Data/04_Uni/03_Master_Thesis/SNOW/02_data/Sentinel_Data/SWS/SWS_analytics/df_datestamp"
 
 
-# Load the DataFrame
-df_datestamp = pd.read_csv(path_to_file)
-
-
-# Convert the 'date' column to datetime type
-df_datestamp['Date'] = pd.to_datetime(df_datestamp['Date'])
-
-# Set the 'date' column as the index
-df_datestamp.set_index('Date', inplace=True)
+# Load the DataFrame, indexed by the native datetime 'Date' column
+df_datestamp = load_results(path_to_store)
 
 # Plotting mean of wet snow
 plt.figure(figsize=(10, 6))
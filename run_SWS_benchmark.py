@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+'''
+This script benchmarks the SWS processing offline on synthetic archives.
+It writes synthetic SWS zips (see write_synthetic_archive) for several archive sizes,
+times df_from_dir, readRaster, clipArray, the reclassification, the scene statistics,
+write_grid with each output profile and the plotting functions on them and compares the times to a stored baseline.
+Times slower than the baseline by more than the tolerance are flagged as regressions.
+Run with --update-baseline to store the current times as the new baseline.
+@author: luis
+'''
+
+import os
+import sys
+import json
+import time
+import matplotlib
+matplotlib.use("Agg")  # Plots are only written to files
+from functions_sentinel import *
+from datetime import datetime as dt
+import pandas as pd
+
+# Folder of the synthetic archives, the outputs of the benchmark and the baseline
+benchmark_folder = "/home/luis/Data/04_Uni/03_Master_Thesis/SNOW/02_data/Sentinel_Data/SWS/SWS_benchmark"
+log_path = os.path.join(benchmark_folder, "benchmark_log.jsonl")
+baseline_path = os.path.join(benchmark_folder, "baseline.json")
+# Numbers of scenes of the benchmarked archives
+archive_sizes = [10, 50, 200]
+# Rows and columns of the synthetic scenes, 1830 is a full tile at 60 m
+tile_size = 1830
+# Number of scenes plotted per archive, plotting a full archive takes too long
+plot_scenes = 3
+# Output profile of the grids that are plotted, see WRITE_PROFILES
+output_profile = "cog"
+# Each benchmark is repeated and the fastest run is kept
+repeats = 3
+# Relative slowdown against the baseline that is flagged as a regression
+tolerance = 0.2
+# AOI of the clip, the bounds of the Zugspitze AOI (minX, maxX, minY, maxY) in EPSG:32632
+bounds_aoi = (640000.0, 670000.0, 5240000.0, 5270000.0)
+update_baseline = "--update-baseline" in sys.argv[1:]
+
+
+def best_time(function, *args):
+    """
+    Runs a function repeats times and returns the fastest wall time in seconds.
+
+    Parameters:
+    function (callable): The benchmarked function.
+    *args: The arguments of the function.
+
+    Returns:
+    float: The fastest wall time in seconds.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark_archive(zipfiles, archive_folder, output_folder):
+    """
+    Times the processing steps on all scenes of a synthetic archive, the plots on
+    the first plot_scenes scenes.
+
+    Parameters:
+    zipfiles (list): The zips of the archive, see write_synthetic_archive.
+    archive_folder (str): The folder of the archive.
+    output_folder (str): The folder for the written grids and plots.
+
+    Returns:
+    dict: The wall time in seconds of each benchmark.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    scene_names = [os.path.basename(zipfilepath)[:-4] for zipfilepath in zipfiles]
+    scenes = [vsizip_path(zipfilepath, "{}/{}_WSM.tif".format(scene_name, scene_name))
+              for zipfilepath, scene_name in zip(zipfiles, scene_names)]
+
+    # Read all scenes once, the following steps work on the decoded data
+    rasters = [readRaster(scene) for scene in scenes]
+    params = [[geotrans[0], geotrans[3], geotrans[1]] for data, geotrans, projection, bounds in rasters]
+    clips = [clipArray(raster[0], param, bounds_aoi, log_path) for raster, param in zip(rasters, params)]
+    outnames = ["SWS_{}.tif".format(dt.strptime(scene_name.split("_")[1], "%Y%m%dT%H%M%S").strftime("%Y_%m_%d_%H_%M"))
+                for scene_name in scene_names]
+    color_table = build_color_table()
+
+    # reclassify works in place, each run reclassifies fresh copies
+    def reclassify_all():
+        for clip, geotrans in clips:
+            reclassify(clip.copy(), "all_classes")
+
+    # Grids of each output profile are written to their own folder
+    def write_all(profile_name):
+        os.makedirs(os.path.join(output_folder, profile_name), exist_ok=True)
+        for (clip, geotrans), raster, outname in zip(clips, rasters, outnames):
+            write_grid(os.path.join(output_folder, profile_name, outname), clip, geotrans, raster[2], log_path,
+                       dtype=gdal.GDT_Byte, output_profile=profile_name, nodata=255, color_table=color_table)
+
+    times = {
+        "df_from_dir": best_time(df_from_dir, archive_folder),
+        "readRaster": best_time(lambda: [readRaster(scene) for scene in scenes]),
+        "clipArray": best_time(lambda: [clipArray(raster[0], param, bounds_aoi, log_path)
+                                        for raster, param in zip(rasters, params)]),
+        "reclassify": best_time(reclassify_all),
+        "scene_statistics": best_time(lambda: [scene_statistics(clip, "all_classes") for clip, geotrans in clips]),
+    }
+    for profile_name in WRITE_PROFILES:
+        times[f"write_grid_{profile_name}"] = best_time(write_all, profile_name)
+    outfiles = [os.path.join(output_folder, output_profile, outname) for outname in outnames]
+    # The plots are timed once, on the written grids
+    start = time.perf_counter()
+    for outfile in outfiles[:plot_scenes]:
+        process_and_plot_tif_all_classes(outfile, output_folder)
+    times["plot_all_classes"] = time.perf_counter() - start
+    start = time.perf_counter()
+    for outfile in outfiles[:plot_scenes]:
+        process_and_plot_tif_binary(outfile, output_folder)
+    times["plot_binary"] = time.perf_counter() - start
+    return times
+
+
+### Main benchmark
+os.makedirs(benchmark_folder, exist_ok=True)
+setup_logging(log_path)
+
+results = []
+for n_scenes in archive_sizes:
+    archive_folder = os.path.join(benchmark_folder, "archive_{}_{}".format(n_scenes, tile_size))
+    logger.info(f"Writing synthetic archive of {n_scenes} scenes to {archive_folder}")
+    zipfiles = write_synthetic_archive(archive_folder, n_scenes, log_path, size=tile_size)
+    logger.info(f"Benchmarking archive of {n_scenes} scenes")
+    times = benchmark_archive(zipfiles, archive_folder, os.path.join(benchmark_folder, "output_{}".format(n_scenes)))
+    results += [{"benchmark": name, "scenes": n_scenes, "seconds": seconds} for name, seconds in times.items()]
+results = pd.DataFrame(results)
+
+# Compare to the baseline, benchmarks missing from the baseline are not flagged
+baseline = None
+if os.path.isfile(baseline_path) and not update_baseline:
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline["tile_size"] != tile_size:
+        logger.warning(f"Baseline was measured with tile size {baseline['tile_size']}, not comparing")
+        baseline = None
+if baseline is not None:
+    baseline = pd.DataFrame(baseline["results"]).rename(columns={"seconds": "baseline"})
+    results = results.merge(baseline, on=["benchmark", "scenes"], how="left")
+else:
+    results["baseline"] = np.nan
+results["ratio"] = results["seconds"] / results["baseline"]
+results["regression"] = results["ratio"] > 1 + tolerance
+
+logger.info("Benchmark results:\n{}".format(results.to_string(index=False, float_format=lambda value: f"{value:.3f}")))
+with open(os.path.join(benchmark_folder, "benchmark_{}.json".format(dt.now().strftime("%Y%m%dT%H%M%S"))), "w") as result_file:
+    result_file.write(results.to_json(orient="records", indent=1))
+
+# Store the times as the new baseline on the first run or if requested
+if update_baseline or not os.path.isfile(baseline_path):
+    with open(baseline_path, "w") as baseline_file:
+        json.dump({"created": str(dt.now()), "tile_size": tile_size, "repeats": repeats,
+                   "results": json.loads(results[["benchmark", "scenes", "seconds"]].to_json(orient="records"))},
+                  baseline_file, indent=1)
+    logger.info(f"Stored the results as baseline in {baseline_path}")
+
+if results["regression"].any():
+    logger.warning("Performance regressions against the baseline:\n{}".format(
+        results[results["regression"]].to_string(index=False)))
+    sys.exit(1)
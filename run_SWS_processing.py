@@ -4,15 +4,20 @@ Created on Tuesday Jul 14 15:02:12 2024
 
 This script takes Sentinel SWS data in a directory in this format: 
     SWS_20180101T170648_S1A_T32TPT_V101_1.zip
-It unzips the files, opens the geotiff, crops it to the AOI,
-Calulates mean and sum of wet snow pixels and saves it to a df
+It opens the geotiff directly inside the zip files, crops it to the AOI,
+Calulates mean and sum of wet snow pixels and the fraction of each SWS class and
+appends them to a season partitioned Parquet results store
 Saves the newly created geotiffs to a directory
+Run with --profile to report the time, I/O and memory of every processing stage
 @author: luis
 '''
 
 import os
-import glob
-import zipfile
+import sys
+import tempfile
+from contextlib import closing
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from functions_sentinel import * 
 from osgeo import gdal
 from datetime import datetime as dt
@@ -20,152 +25,280 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
-# Define paths for data folder, AOI shapefile, mask file, temporary directory, log file, and output folder
+# Define paths for data folder, AOI shapefile, mask file, log file, and output folder
 data_folder = "/home/luis/Data/04_Uni/03_Master_Thesis/SNOW/02_data/Sentinel_Data/SWS/SWS_raw_files"
 aoi_path = '/home/luis/Data/04_Uni/03_Master_Thesis/SNOW/02_data/Shapefiles/shapefile_Zugspitze/03_AOI_shp_zugspitze_reproj_for_code/AOI_zugspitze_reproj_32632.shp' #/shapefile_new_approach/mask_catchments_32632.asc
 mask_file_path = "/home/luis/Data/04_Uni/03_Master_Thesis/SNOW/02_data/Shapefiles/shapefile_Zugspitze/04_AOI_shapefile_Zugspitze_Watershed/shapefile_new_approach/mask_catchments_32632.asc"
-local_temp = "/home/luis/Data/04_Uni/03_Master_Thesis/SNOW/02_data/Sentinel_Data/code/temp"
-log_path = "/home/luis/Data/04_Uni/03_Master_Thesis/SNOW/02_data/Sentinel_Data/code/logfile.txt"
+log_path = "/home/luis/Data/04_Uni/03_Master_Thesis/SNOW/02_data/Sentinel_Data/code/logfile.jsonl"
+# Verbosity of the log, "DEBUG" also logs the per-scene reading and writing steps
+log_level = "INFO"
 # Path to df_datestamp where wetsnow sums and means are saved
 analytic_path = "/home/luis/Data/04_Uni/03_Master_Thesis/SNOW/02_data/Sentinel_Data/SWS/SWS_analytics"
+results_store = os.path.join(analytic_path, "df_datestamp")
+# Data cube collecting the clipped daily AOI arrays in one (time, y, x) store
+cube_path = os.path.join(analytic_path, "SWS_cube")
 output_folder = '/home/luis/Data/04_Uni/03_Master_Thesis/SNOW/02_data/Sentinel_Data/SWS/SWS_all_data_processed/all_classes'
+# Manifest of the processed scenes and days, reruns skip the work that is still valid
+manifest_path = os.path.join(analytic_path, "processing_manifest.sqlite")
+# Reclassification scheme of the SWS codes, see CLASS_SCHEMES in functions_sentinel
+class_scheme = "all_classes"
+# Compute the statistics only inside the AOI polygons instead of their bounding box
+use_aoi_mask = True
+# Directory of the cached rasterized AOI masks
+mask_cache = os.path.join(analytic_path, "aoi_masks")
+# Count the classes per catchment zone of mask_file_path
+use_zones = True
+# Long format table of the per zone class counts
+zonal_store = os.path.join(analytic_path, "zonal_statistics")
+# DEM for the wet snow statistics per elevation band and aspect class, e.g. a GeoTIFF
+# in EPSG:32632 covering the AOI, None to skip them
+dem_path = None
+# Height of the elevation bands in meters
+band_width = 250
+# Directory of the cached elevation band and aspect class indices
+band_cache = os.path.join(analytic_path, "dem_bands")
+# Long format table of the per band wet, dry and valid counts
+banded_store = os.path.join(analytic_path, "banded_statistics")
+# Layout and compression of the written daily grids, see WRITE_PROFILES in functions_sentinel.
+# "cog" writes tiled Cloud Optimized GeoTIFFs with overviews, "lzw" the former striped files
+output_profile = "cog"
+# Rule merging the scenes of one day: "latest", "wet_wins" or "valid_first", see composite_scenes
+composite_rule = "valid_first"
+# Number of worker processes, days are processed in parallel if > 1
+n_workers = os.cpu_count()
+# Compression threads of each written grid, the cores are shared by the worker processes
+write_threads = max(1, (os.cpu_count() or 1) // n_workers)
+# Record the time, I/O and memory of every processing stage, enabled by running
+# the script with --profile. The report is written to profile_path
+profile = "--profile" in sys.argv[1:]
+profile_path = os.path.join(analytic_path, "profile_{}.json".format(dt.now().strftime("%Y%m%dT%H%M%S")))
 
 ### Main Processing
+# Log to the console and, buffered as JSON lines, to the log file
+setup_logging(log_path, log_level)
+if profile:
+    enable_profiling()
+
 # Create a dataframe from the directory of zip files
-scenes_df = df_from_dir(data_folder)
+with profile_stage("scan"):
+    scenes_df = df_from_dir(data_folder)
 grouped = scenes_df.groupby(["sensdate"])
 days = scenes_df["sensdate"].unique()
 # get bounds from shapefile
 bounds_aoi = getBounds_Shp(aoi_path)
 # get bounds from ASCII grid
 # bounds_aoi = get_bounds_from_mask(mask_file_path)
-# Initialize dataframe to store results
-df_datestamp = pd.DataFrame(index=pd.Index(days, name='Date'))
-df_datestamp["wetsnow_mean"] = np.nan
-df_datestamp["wetsnow_sum"] = np.nan
-
-# iterate through days
-for day in days:
-    # Clear the temporary directory before processing each day
-    clear_temp_directory(local_temp)
-    group = grouped.get_group((day,))
-    mean_datetime = str(group.sensdatetime.mean())
-    print("processing {} with {} scenes".format(str(day)[0:10], group.shape[0]))
-
-    # Define output file path
-    outfile = "{}{}SWS_{}_{}.tif".format(
-        output_folder,
-        os.path.sep,
-        mean_datetime[0:10].replace("-", "_"),
-        mean_datetime[11:16].replace(":", "_"),
-    )
-
-    # Check if the output file already exists
-    if os.path.isfile(outfile):
-        print("File {} already exists, skipping processing!".format(os.path.basename(outfile)))
+# Keys of the current AOI and class scheme in the processing manifest
+aoi_key = aoi_hash(bounds_aoi, [shapefile_hash(aoi_path) if use_aoi_mask else None,
+                                shapefile_hash(mask_file_path) if use_zones else None,
+                                [shapefile_hash(dem_path), band_width] if dem_path else None])
+scheme_key = scheme_hash(class_scheme)
+
+# Build the AOI mask, zone index and DEM bands of the AOI grid once, before the
+# workers are forked, which then share them
+for scene_name in scenes_df["filename"]:
+    try:
+        data_aoi, geotrans_aoi, projection, bounds = readRasterWindow(
+            vsizip_path("{}{}{}.zip".format(data_folder, os.path.sep, scene_name),
+                        "{}/{}_WSM.tif".format(scene_name, scene_name)), bounds_aoi, log_path)
+    except Exception:
         continue
+    if use_aoi_mask:
+        aoi_mask(aoi_path, geotrans_aoi, data_aoi.shape, projection, mask_cache)
+    if use_zones:
+        zone_index(mask_file_path, geotrans_aoi, data_aoi.shape, projection)
+    if dem_path:
+        dem_bands(dem_path, geotrans_aoi, data_aoi.shape, projection, band_cache, band_width)
+    break
+
+def process_day(day, group):
+    """
+    Processes all scenes of one day group and writes the clipped grid of the day.
+
+    Parameters:
+    day (Timestamp): The sensing date of the day group.
+    group (DataFrame): The scenes of the day group from scenes_df.
+
+    Returns:
+    tuple: A tuple containing:
+        - records (list): A list of (date, statistics) tuples, one per scene, see scene_statistics.
+          The rows of zonal_statistics and banded_statistics are under the "zonal" and
+          "banded" keys of the statistics.
+          The statistics are None for scenes containing only NaN values.
+        - cached (bool): True if the records were taken from the processing manifest.
+        - frame (tuple): The (time, data, geotransform, projection WKT) of the clipped data
+          written for the day, None if nothing was written or the day is already in the cube.
+        - profile (list): The stage records of the day, see profile_stage.
+    """
+    records = []
+    # Isolated scratch space, so that parallel workers never share temporary files
+    with tempfile.TemporaryDirectory() as scratch, closing(open_manifest(manifest_path)) as manifest:
+        gdal.SetConfigOption("CPL_TMPDIR", scratch)
+        mean_datetime = str(group.sensdatetime.mean())
+        logger.info("processing {} with {} scenes".format(str(day)[0:10], group.shape[0]))
+
+        # Define output file path
+        outfile = "{}{}SWS_{}_{}.tif".format(
+            output_folder,
+            os.path.sep,
+            mean_datetime[0:10].replace("-", "_"),
+            mean_datetime[11:16].replace(":", "_"),
+        )
+
+        # Check if the day and all its scenes were already processed with the same
+        # AOI, class scheme and code version, and the output file still exists
+        written = manifest_get_day(manifest, outfile, aoi_key, scheme_key, composite_rule)
+        cached = [manifest_get_scene(manifest, scene_name, aoi_key, scheme_key) for scene_name in group["filename"]]
+        if written is not None and (not written or os.path.isfile(outfile)) and all(found for found, _ in cached):
+            logger.info("File {} already processed, skipping processing!".format(os.path.basename(outfile)))
+            for scene_name, (found, stats) in zip(group["filename"], cached):
+                records.append((dt.strptime(scene_name.split("_")[1], "%Y%m%dT%H%M%S"), stats))
+            # Days of an interrupted run may be missing from the cube, read them back from the output file
+            frame = None
+            if written and pd.Timestamp(group.sensdatetime.mean()).isoformat() not in cube_times(cube_path):
+                data_day, geotrans_day, projection_day, bounds = readRaster(outfile)
+                frame = (group.sensdatetime.mean(), data_day, list(geotrans_day), projection_day.ExportToWkt())
+            return records, True, frame, take_profile_records()
+
+        # Whether all scenes of the day could be read
+        all_read = True
+
+        # Clipped data of the valid scenes of the day, as (date, data, geotransform)
+        day_scenes = []
+
+        # Iterate through each scene, reading the WSM tif directly from its zip archive
+        for scene_name in group["filename"]:
+            zipfilepath = "{}{}{}.zip".format(data_folder, os.path.sep, scene_name)
+            scene = vsizip_path(zipfilepath, "{}/{}_WSM.tif".format(scene_name, scene_name))
+
+            # read only the AOI window of the raster
+            try:
+                with profile_stage("read", scene_name):
+                    data_aoi, geotrans_aoi, projection, bounds = readRasterWindow(scene, bounds_aoi, log_path)
+            except Exception as e:
+                writeLog(log_path, "Couldnt read file {} for folowing reason: {}".format(zipfilepath, e))
+                all_read = False
+                continue
+
+            # Extract the date from the filename
+            scene_filename = os.path.basename(scene)
+            date_str = scene_filename.split("_")[1]
+            current_date = dt.strptime(date_str, "%Y%m%dT%H%M%S")
+
+            # Skip processing if the data contains only NaN values
+            if np.all(data_aoi == 255):
+                logger.info(f"Skipping and removing scene {scene} as it contains only NaN values.")
+                records.append((current_date, None))
+                manifest_put_scene(manifest, scene_name, aoi_key, scheme_key, None)
+                continue
 
-    # Extract files from zip archives
-    for i, scene_name in enumerate(group["filename"]):
-        zipfilepath = "{}{}{}.zip".format(data_folder, os.path.sep, scene_name)
-        fileoutpath = "{}{}{}.tif".format(local_temp, os.path.sep, scene_name)
-
-        try:
-            with zipfile.ZipFile(zipfilepath) as z:
-                with open(fileoutpath, "wb") as f:
-                    f.write(z.read("{}/{}_WSM.tif".format(scene_name, scene_name)))
-        except Exception as e:
-            writeLog(log_path, "Couldnt unzip file {} for folowing reason: {}".format(e, zipfilepath))
-
-    # Find the unzipped tif files
-    scenes = glob.glob("{}{}SWS*.tif".format(local_temp, os.path.sep))
-
-    # Iterate through each tif file
-    for scene in scenes:
-        # readraster
-        rasterarray, scene_geotrans, projection, bounds = readRaster(scene)
-        rasterarray = rasterarray
-
-        # get some infos from topo geotrans
-        scene_min_x = scene_geotrans[0]
-        scene_min_y = scene_geotrans[3]
-        scene_res = scene_geotrans[1]
-        # create topo_params list for clipping
-        scene_params = [scene_min_x, scene_min_y, scene_res]
-
-        # clip raster 
-        data_aoi, geotrans_aoi = clipArray(rasterarray, scene_params, bounds_aoi, log_path)
-        # Extract the date from the filename
-        scene_filename = os.path.basename(scene)
-        date_str = scene_filename.split("_")[1]
-        current_date = dt.strptime(date_str, "%Y%m%dT%H%M%S")
-
-        # Skip processing if the data contains only NaN values
-        if np.all(data_aoi == 255):
-            print(f"Skipping and removing scene {scene} as it contains only NaN values.")
-            # Remove the corresponding date from the DataFrame
-            if current_date in df_datestamp.index:
-                df_datestamp = df_datestamp.drop(current_date)
-            else:
-                print(f"{current_date} not found in DataFrame index, skipping drop.")
+            # Calculate class statistics and mean and sum of wet snow pixels
+            with profile_stage("mask", scene_name):
+                mask = aoi_mask(aoi_path, geotrans_aoi, data_aoi.shape, projection, mask_cache) if use_aoi_mask else None
+            with profile_stage("statistics", scene_name):
+                stats = scene_statistics(data_aoi, class_scheme, mask)
+            if use_zones:
+                with profile_stage("zonal", scene_name):
+                    stats["zonal"] = zonal_statistics(data_aoi, *zone_index(mask_file_path, geotrans_aoi,
+                                                                            data_aoi.shape, projection))
+            if dem_path:
+                with profile_stage("banded", scene_name):
+                    stats["banded"] = banded_statistics(data_aoi, *dem_bands(dem_path, geotrans_aoi, data_aoi.shape,
+                                                                             projection, band_cache, band_width), mask)
+            meanwetsnowarea = stats["wetsnow_mean"]
+            sumwetsnowpixels = stats["wetsnow_sum"]
+
+            logger.debug("meanwetsnowpart of scene is: {}".format(meanwetsnowarea))
+            logger.debug("wetsnowsum of scene is: {}".format(sumwetsnowpixels))
+
+            # Keep the clipped data of valid scenes for the day composite
+            if not np.isnan(meanwetsnowarea and sumwetsnowpixels):
+                day_scenes.append((current_date, data_aoi, geotrans_aoi))
+
+            # Store results of the scene
+            records.append((current_date, stats))
+            with profile_stage("manifest", scene_name):
+                manifest_put_scene(manifest, scene_name, aoi_key, scheme_key, stats)
+
+        # Merge the scenes of the day and write the clipped data once
+        frame = None
+        if day_scenes:
+            day_scenes.sort(key=lambda day_scene: day_scene[0])
+            with profile_stage("composite", os.path.basename(outfile)):
+                data_day = composite_scenes([day_scene[1] for day_scene in day_scenes],
+                                            [day_scene[2] for day_scene in day_scenes], composite_rule)
+
+            # replace specific values in the clipped data, use "binary" to set
+            # the classes other than wet and dry snow to noData
+            with profile_stage("reclassify", os.path.basename(outfile)):
+                reclassify(data_day, class_scheme)
+            with profile_stage("write", os.path.basename(outfile)):
+                write_grid(outfile, data_day, day_scenes[0][2], projection, log_path, dtype=gdal.GDT_Byte,
+                           output_profile=output_profile, nodata=255, color_table=build_color_table(class_scheme),
+                           num_threads=write_threads)
+            frame = (group.sensdatetime.mean(), data_day, day_scenes[0][2], projection.ExportToWkt())
+
+        # Record the day as done, days with unreadable scenes are retried on the next run
+        if all_read:
+            manifest_put_day(manifest, outfile, aoi_key, scheme_key, composite_rule, bool(day_scenes))
+
+    return records, False, frame, take_profile_records()
+
+
+# iterate through days, in parallel worker processes if n_workers > 1
+day_results = {}
+if n_workers > 1:
+    # workers are forked, this script has no __main__ guard to be re-imported safely
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        futures = {executor.submit(process_day, day, grouped.get_group((day,))): day for day in days}
+        for future in as_completed(futures):
+            day_results[futures[future]] = future.result()
+else:
+    for day in days:
+        day_results[day] = process_day(day, grouped.get_group((day,)))
+for day in day_results:
+    add_profile_records(day_results[day][3])
+
+# Collect the results of the newly processed days, and of the days taken from the
+# manifest that are missing from the store, in date order.
+# Scenes containing only NaN values are left out
+stored_dates = set(load_results(results_store).index)
+new_records = []
+new_zonal_records = []
+new_banded_records = []
+for day in sorted(day_results):
+    for current_date, stats in day_results[day][0]:
+        if stats is None or (day_results[day][1] and current_date in stored_dates):
             continue
+        stats = dict(stats)
+        new_zonal_records += [
+            {"Date": current_date, "zone": zone, "class": name, "count": count, "fraction": fraction}
+            for zone, name, count, fraction in stats.pop("zonal", [])
+        ]
+        new_banded_records += [
+            {"Date": current_date, "elevation": elevation, "aspect": aspect, "wet": wet, "dry": dry, "valid": valid}
+            for elevation, aspect, wet, dry, valid in stats.pop("banded", [])
+        ]
+        new_records.append(dict(Date=current_date, **stats))
+
+# Append the new results to the store and load the full record
+with profile_stage("store"):
+    append_results(results_store, pd.DataFrame(new_records))
+    append_results(zonal_store, pd.DataFrame(new_zonal_records))
+    append_results(banded_store, pd.DataFrame(new_banded_records))
+df_datestamp = load_results(results_store)
+logger.info(f"{len(new_records)} new records saved to {results_store}")
+
+# Append the clipped data of the newly processed days to the data cube, in date order
+for day in sorted(day_results):
+    frame = day_results[day][2]
+    if frame is not None:
+        with profile_stage("cube"):
+            append_to_cube(cube_path, *frame)
 
-        # # replace specific values in the clipped data
-        # # Set unwanted classes na and wet and dry snow to binary
-        # data_aoi[data_aoi == 110] = 1
-        # # Dry snow or snow free or patchy snow
-        # data_aoi[data_aoi == 125] = 0
-        # # Radar shadow / layover / foreshortening
-        # data_aoi[data_aoi == 200] = 255
-        # # Water
-        # data_aoi[data_aoi == 210] = 255
-        # # Forest
-        # data_aoi[data_aoi == 220] = 255
-        # # Urban area
-        # data_aoi[data_aoi == 230] = 255
-        # # Non-mountain areas
-        # data_aoi[data_aoi == 240] = 255
-
-        # replace specific values in the clipped data
-        # Set unwanted classes na and wet and dry snow to binary
-        data_aoi[data_aoi == 110] = 1
-        # Dry snow or snow free or patchy snow
-        data_aoi[data_aoi == 125] = 0
-        # Radar shadow / layover / foreshortening
-        data_aoi[data_aoi == 200] = 21
-        # Water
-        data_aoi[data_aoi == 210] = 22
-        # Forest
-        data_aoi[data_aoi == 220] = 23
-        # Urban area
-        data_aoi[data_aoi == 230] = 24
-        # Non-mountain areas
-        data_aoi[data_aoi == 240] = 25
-
-
-        # Calculate mean and sum of wet snow pixels
-        meanwetsnowarea = np.nanmean(data_aoi[data_aoi != 255])
-        sumwetsnowpixels = np.nansum(data_aoi[data_aoi != 255])
-
-        print("meanwetsnowpart of scene is: {}".format(meanwetsnowarea))
-        print("wetsnowsum of scene is: {}".format(sumwetsnowpixels))
-
-        # Write the clipped data to a grid file if valid
-        if not np.isnan(meanwetsnowarea and sumwetsnowpixels):
-            write_grid(outfile, data_aoi, geotrans_aoi, projection, log_path, dtype=gdal.GDT_Byte)
-
-        # Store results in the dataframe
-        df_datestamp.loc[current_date, 'wetsnow_mean'] = meanwetsnowarea
-        df_datestamp.loc[current_date, 'wetsnow_sum'] = sumwetsnowpixels
-
-    # Clear the temporary directory after processing each day
-    clear_temp_directory(local_temp)
-    
-    
-# After creating df_datestamp, save it to analytic_path
-df_datestamp_path = os.path.join(analytic_path, "df_datestamp.csv")
-df_datestamp.to_csv(df_datestamp_path, index=True)
-print(f"DataFrame saved to {df_datestamp_path}")
+# Write the stage profile of the run
+if profile:
+    profile_report(profile_path)
 
 ## short plot
 # Plotting mean of wet snow
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+'''
+This script streams through the processed daily SWS tif files and writes per-pixel
+temporal products as GeoTIFFs: wet snow frequency, first and last wet snow day and
+longest wet spell per season, and maximum wet snow extent per month and season.
+Only the running per-pixel state is kept in memory.
+@author: luis
+'''
+from functions_sentinel import iter_daily_rasters, temporal_statistics, setup_logging, logger
+
+
+# Specify the input directory containing the processed daily TIF files
+input_directory = '/home/luis/Data/04_Uni/03_Master_Thesis/SNOW/02_data/Sentinel_Data/SWS/SWS_all_data_processed/all_classes'
+# Specify the output directory to save the temporal products
+output_directory = '/home/luis/Data/04_Uni/03_Master_Thesis/SNOW/02_data/Sentinel_Data/SWS/SWS_analytics/SWS_temporal_statistics'
+log_path = "/home/luis/Data/04_Uni/03_Master_Thesis/SNOW/02_data/Sentinel_Data/code/logfile.jsonl"
+
+# Log to the console and, buffered as JSON lines, to the log file
+setup_logging(log_path)
+
+written = temporal_statistics(iter_daily_rasters(input_directory), output_directory, log_path)
+logger.info(f"Wrote {len(written)} temporal products to {output_directory}")
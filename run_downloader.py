@@ -1,9 +1,12 @@
 import os
 import glob
 import shutil
+import datetime
 
 start_date = "2018-01-01"
-end_date = "2024-07-16"
+# moving end date, with the catalogue later runs only request the newly observed
+# or newly published products
+end_date = datetime.date.today().isoformat()
 data_storage = "data"
 local_temp_storage = "./temp"
 
@@ -12,14 +15,25 @@ product_type = "FSC"
 
 cloudcover = "10"
 
+# number of products downloaded or catalogue pages requested concurrently
+max_workers = 4
+# number of date shards the catalogue query is split into
+query_shards = 6
+# local catalogue caching the query results, later runs only query newly published products
+catalogue_file = "{}/catalogue.sqlite".format(data_storage)
+# archive members fetched instead of the whole product (e.g. "WSM" for SWS), "" downloads everything
+members = ""
+
 tile_list = ['32TPT']
 
 for tile in tile_list:
     print("Searching for tile {}".format(tile))
     callstring = (
         "python ./CLMS_downloader.py {} -query -productType {} -productIdentifier {} "
-        "-obsDateMin {}T00:00:00Z -obsDateMax {}T00:00:00Z -cloudCoverageMax {}".format(
-            local_temp_storage, product_type, tile, start_date, end_date, cloudcover
+        "-obsDateMin {}T00:00:00Z -obsDateMax {}T00:00:00Z -cloudCoverageMax {} "
+        "-query_shards {} -max_workers {} -catalogue {}".format(
+            local_temp_storage, product_type, tile, start_date, end_date, cloudcover,
+            query_shards, max_workers, catalogue_file
         )
     )
     os.system(callstring)
@@ -49,8 +63,12 @@ for tile in tile_list:
         ## Hier wird das auszuführende Skript gecalled!! ##
         callstring = (
             "python ./clms_hrsi_downloader_new.py {} -hrsi_credentials {} -download "
-            "-result_file {}/result_file.txt".format(local_temp_storage, credential_file, local_temp_storage)
+            "-result_file {}/result_file.txt -max_workers {}".format(
+                local_temp_storage, credential_file, local_temp_storage, max_workers
+            )
         )
+        if members:
+            callstring += " -members {}".format(members)
         os.system(callstring)
 
 for file in glob.glob("{}/*.zip".format(local_temp_storage)):